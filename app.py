@@ -1,61 +1,303 @@
 
-from flask import Flask, jsonify, request, send_file, render_template
+from flask import Flask, Response, jsonify, request, send_file, render_template, stream_with_context
 from selenium import webdriver
+from werkzeug.middleware.proxy_fix import ProxyFix
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
 import subprocess
 import os
+import shutil
+import signal
+import asyncio
+import _thread
 import traceback
 import time
 import logging
+import logging.handlers
+import atexit
+import copy
 from io import BytesIO
 import base64
 from PIL import Image
+import hashlib
 import json
+import math
+import queue
+import sqlite3
+import threading
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import datetime
 
-# Set up logging
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] [%(filename)s:%(lineno)d] %(message)s",
-)
+try:
+    import websocket  # websocket-client, installed alongside selenium
+except ImportError:
+    websocket = None
 
-file_handler = logging.FileHandler("app.log")
-file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
-logging.getLogger().addHandler(file_handler)
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Logging: records are queued on the calling thread and written by a
+# background QueueListener. LOG_FILE rotates by size, or by time when
+# LOG_ROTATE_WHEN is set (e.g. "midnight"). Repeats of the same warning or
+# error within LOG_RATE_LIMIT_SECONDS are dropped and counted.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE", "app.log")
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 2**20)))
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN", "")
+LOG_JSON = os.environ.get("LOG_JSON", "0").lower() in ("1", "true", "yes")
+LOG_RATE_LIMIT_SECONDS = float(os.environ.get("LOG_RATE_LIMIT_SECONDS", "60"))
+
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "location": f"{record.filename}:{record.lineno}",
+            "message": record.getMessage()
+        }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RateLimitFilter(logging.Filter):
+    """Drop repeats of the same WARNING+ message within ``window`` seconds
+
+    The next record that gets through reports how many were dropped.
+    """
+
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.window <= 0 or record.levelno < logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno, record.getMessage())
+        now = time.monotonic()
+        with self._lock:
+            last, suppressed = self._seen.get(key, (None, 0))
+            if last is not None and now - last < self.window:
+                self._seen[key] = (last, suppressed + 1)
+                return False
+            self._seen[key] = (now, 0)
+            if len(self._seen) > 1000:
+                self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.window}
+        if suppressed:
+            record.msg = f"{record.getMessage()} ({suppressed} similar suppressed)"
+            record.args = None
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Renders the message and traceback on the caller's thread but leaves
+    the layout to the listener's formatters"""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging():
+    """Route all logging through a queue drained by a background thread"""
+    if LOG_JSON:
+        console_formatter = file_formatter = JsonLogFormatter()
+    else:
+        console_formatter = logging.Formatter("%(asctime)s [%(levelname)s] [%(filename)s:%(lineno)d] %(message)s")
+        file_formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+    
+    handlers = [logging.StreamHandler()]
+    handlers[0].setFormatter(console_formatter)
+    if LOG_FILE:
+        if LOG_ROTATE_WHEN:
+            file_handler = logging.handlers.TimedRotatingFileHandler(
+                LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+        else:
+            file_handler = logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+        file_handler.setFormatter(file_formatter)
+        handlers.append(file_handler)
+    
+    queue_handler = LogQueueHandler(queue.Queue(-1))
+    queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT_SECONDS))
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    
+    listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = configure_logging()
 
 ADMIN_CODE = "ICU14CU"
 MAX_RETRIES = 3
 REQUEST_TIMEOUT = 120
 RESPONSE_TIMEOUT = 90
 
+# Session pool sizing
+POOL_SIZE = int(os.environ.get("POOL_SIZE", "1"))
+POOL_MAX_WAITERS = int(os.environ.get("POOL_MAX_WAITERS", "10"))
+POOL_CHECKOUT_TIMEOUT = float(os.environ.get("POOL_CHECKOUT_TIMEOUT", "30"))
+
+# Multi-tab browsers: up to BROWSER_MAX_TABS sessions share one Chrome
+# process as tabs, each driven through its own CDP target (1 = one Chrome
+# per session). A tab failing its health check is reopened on its own. Its
+# Chrome is relaunched at once when unreachable; after TAB_MAX_FAILURES
+# failed setups of one tab (0 = never), or when the recycle request/age
+# limits are reached, the browser's tabs are drained first.
+BROWSER_MAX_TABS = max(1, int(os.environ.get("BROWSER_MAX_TABS", "1")))
+if BROWSER_MAX_TABS > 1 and websocket is None:
+    # Tabs need their own CDP connection (websocket-client) to run in parallel
+    logging.warning(f"⚠️ BROWSER_MAX_TABS={BROWSER_MAX_TABS} needs websocket-client; using one Chrome per session")
+    BROWSER_MAX_TABS = 1
+TAB_MAX_FAILURES = int(os.environ.get("TAB_MAX_FAILURES", "3"))
+
+# Admission control: checkouts whose estimated queue wait (from recent
+# session hold times) exceeds their timeout are refused at once with 429.
+# Per-client token buckets (API key or client IP); 0 disables them.
+ADMISSION_DEFAULT_HOLD_SECONDS = float(os.environ.get("ADMISSION_DEFAULT_HOLD_SECONDS", "20"))
+RATE_LIMIT_PER_MINUTE = float(os.environ.get("RATE_LIMIT_PER_MINUTE", "0"))
+RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", "10"))
+# Only these X-API-Key values get their own bucket; other callers are keyed
+# by address. TRUSTED_PROXY_HOPS reverse proxies may set X-Forwarded-For.
+RATE_LIMIT_API_KEYS = {k.strip() for k in os.environ.get("RATE_LIMIT_API_KEYS", "").split(",") if k.strip()}
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "0"))
+
+# HTTP serving: a single process owns the browsers (guarded by
+# BROWSER_LOCK_PATH) and HTTP concurrency comes from HTTP_THREADS threads
+HTTP_HOST = os.environ.get("HOST", "0.0.0.0")
+HTTP_PORT = int(os.environ.get("PORT", "10000"))
+HTTP_THREADS = int(os.environ.get("HTTP_THREADS", str(max(8, POOL_SIZE * 4))))
+SHUTDOWN_DRAIN_SECONDS = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", "60"))
+BROWSER_LOCK_PATH = os.environ.get("BROWSER_LOCK_PATH", "/tmp/chatgpt-browsers.lock")
+
+# Background job queue
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", str(POOL_SIZE)))
+JOB_QUEUE_MAX = int(os.environ.get("JOB_QUEUE_MAX", "1000"))
+JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_SECONDS", "600"))
+JOB_MAX_WAIT = float(os.environ.get("JOB_MAX_WAIT", "60"))
+JOB_CHECKOUT_TIMEOUT = float(os.environ.get("JOB_CHECKOUT_TIMEOUT", "300"))
+
+# Batch endpoint limits
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", str(POOL_SIZE)))
+
+# Conversation affinity: threads are rotated after CONVERSATION_MAX_TURNS
+# turns so the page (and every selector scan over it) stays small
+CONVERSATION_MAX_TURNS = int(os.environ.get("CONVERSATION_MAX_TURNS", "20"))
+CONVERSATION_TTL_SECONDS = int(os.environ.get("CONVERSATION_TTL_SECONDS", "3600"))
+
+# Response cache (disabled by default; CACHE_DB_PATH enables the SQLite tier)
+CACHE_ENABLED = os.environ.get("CACHE_ENABLED", "0").lower() in ("1", "true", "yes")
+CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES", "500"))
+CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", "3600"))
+CACHE_DB_PATH = os.environ.get("CACHE_DB_PATH", "")
+CACHE_DB_MAX_ENTRIES = int(os.environ.get("CACHE_DB_MAX_ENTRIES", "10000"))
+
+# Share one browser round trip between concurrent identical queries
+COALESCE_ENABLED = os.environ.get("COALESCE_ENABLED", "1").lower() in ("1", "true", "yes")
+
+# Background health probing for /status
+HEALTH_PROBE_INTERVAL = float(os.environ.get("HEALTH_PROBE_INTERVAL", "30"))
+
+# Browser recycling, checked by the health prober on idle sessions only.
+# Over RECYCLE_SOFT_HEAP_MB the chat thread is cleared, over RECYCLE_HEAP_MB
+# the tab is reloaded and, if that does not help, Chrome is restarted. The
+# request and age limits restart Chrome outright. 0 disables a limit.
+RECYCLE_MAX_REQUESTS = int(os.environ.get("RECYCLE_MAX_REQUESTS", "200"))
+RECYCLE_MAX_AGE_MINUTES = float(os.environ.get("RECYCLE_MAX_AGE_MINUTES", "240"))
+RECYCLE_SOFT_HEAP_MB = int(os.environ.get("RECYCLE_SOFT_HEAP_MB", "256"))
+RECYCLE_HEAP_MB = int(os.environ.get("RECYCLE_HEAP_MB", "384"))
+
+# Response completion detection: the in-page MutationObserver resolves after
+# RESPONSE_QUIET_MS without changes; polling is only a fallback.
+RESPONSE_QUIET_MS = int(os.environ.get("RESPONSE_QUIET_MS", "800"))
+RESPONSE_POLL_INTERVAL_MS = int(os.environ.get("RESPONSE_POLL_INTERVAL_MS", "2000"))
+RESPONSE_STABLE_CHECKS = int(os.environ.get("RESPONSE_STABLE_CHECKS", "3"))
+
+# A session that just answered cleanly is trusted for this long: requests
+# in between only run a one-script sentinel instead of the full health
+# check and popup sweep
+HEALTH_RECHECK_IDLE_SECONDS = float(os.environ.get("HEALTH_RECHECK_IDLE_SECONDS", "60"))
+
+# Upper bounds for condition-based waits (seconds)
+SETUP_READY_TIMEOUT = float(os.environ.get("SETUP_READY_TIMEOUT", "30"))
+POPUP_SETTLE_TIMEOUT = float(os.environ.get("POPUP_SETTLE_TIMEOUT", "2"))
+SEND_RETRY_READY_TIMEOUT = float(os.environ.get("SEND_RETRY_READY_TIMEOUT", "5"))
+
+# Optional CDP event transport: a second DevTools websocket per page that
+# pushes DOM updates (Runtime.bindingCalled) and the conversation's network
+# stream to Python instead of polling through chromedriver
+CDP_TRANSPORT = os.environ.get("CDP_TRANSPORT", "0").lower() in ("1", "true", "yes")
+CDP_STREAM_URL_PATTERN = os.environ.get("CDP_STREAM_URL_PATTERN", "/conversation")
+CDP_BINDING_NAME = "__cdpEmit"
+
+# /api/screenshot: pages taller than SCREENSHOT_TILE_HEIGHT are captured in
+# tiles and stitched after the session is back in the pool; results are
+# reused for SCREENSHOT_CACHE_TTL seconds
+SCREENSHOT_CACHE_TTL = float(os.environ.get("SCREENSHOT_CACHE_TTL", "5"))
+SCREENSHOT_TILE_HEIGHT = int(os.environ.get("SCREENSHOT_TILE_HEIGHT", "4096"))
+SCREENSHOT_MAX_HEIGHT = int(os.environ.get("SCREENSHOT_MAX_HEIGHT", "16384"))
+SCREENSHOT_FORMATS = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+# How often /ask/stream samples the growing assistant message
+STREAM_POLL_INTERVAL_MS = int(os.environ.get("STREAM_POLL_INTERVAL_MS", "250"))
+
+# Base URL of the chat site; point it at bench/mock_chat.py for offline benchmarks
+CHAT_URL = os.environ.get("CHAT_URL", "https://chatgpt.com").rstrip("/")
+
 user_agent = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36"
 
 app = Flask(__name__)
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 
 chrome_bin = os.environ.get("CHROME_BIN", "/usr/bin/chromium")
 chromedriver_bin = os.environ.get("CHROMEDRIVER_BIN", "/usr/bin/chromedriver")
 
-# Enhanced Chrome options
-options = Options()
-options.binary_location = chrome_bin
-options.add_argument("--headless=new")
-options.add_argument("--no-sandbox")
-options.add_argument("--disable-dev-shm-usage")
-options.add_argument("--disable-gpu")
-options.add_argument("--disable-software-rasterizer")
-options.add_argument("--disable-extensions")
-options.add_argument("--disable-plugins")
-options.add_argument("--disable-images")  # Speed up loading
-options.add_argument("--disable-javascript-harmony")
-options.add_argument("--disable-web-security")
-options.add_argument("--disable-features=TranslateUI")
-options.add_argument("--disable-ipc-flooding-protection")
-options.add_argument(f"--user-agent={user_agent}")
-options.add_argument("--window-size=1920,1080")
+# Profile reuse: each session gets CHROME_PROFILE_ROOT/session-<id>, seeded
+# from CHROME_PROFILE_TEMPLATE when it does not exist yet. Empty disables it.
+CHROME_PROFILE_ROOT = os.environ.get("CHROME_PROFILE_ROOT", "/tmp/chrome-profiles")
+CHROME_PROFILE_TEMPLATE = os.environ.get("CHROME_PROFILE_TEMPLATE", "")
+
+# Flags for memory-constrained containers
+CHROME_LOW_MEMORY = os.environ.get("CHROME_LOW_MEMORY", "1").lower() in ("1", "true", "yes")
+CHROME_JS_HEAP_MB = int(os.environ.get("CHROME_JS_HEAP_MB", "512"))
+CHROME_DISK_CACHE_MB = int(os.environ.get("CHROME_DISK_CACHE_MB", "64"))
 
 # Performance optimizations
 prefs = {
@@ -68,638 +310,3842 @@ prefs = {
         "images": 2
     }
 }
-options.add_experimental_option("prefs", prefs)
-
-service = Service(chromedriver_bin)
-driver = None
-setup_complete = False
-last_activity = None
 
-def initialize_driver():
-    """Initialize Chrome driver with error handling"""
-    global driver
-    try:
-        if driver:
-            driver.quit()
-        driver = webdriver.Chrome(service=service, options=options)
-        driver.set_page_load_timeout(30)
-        driver.implicitly_wait(10)
-        return True
-    except Exception as e:
-        logging.error("❌ Failed to initialize driver", exc_info=True)
-        return False
+def build_chrome_options(user_data_dir=None):
+    """Enhanced Chrome options, optionally bound to a profile directory"""
+    options = Options()
+    options.binary_location = chrome_bin
+    options.add_argument("--headless=new")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--disable-software-rasterizer")
+    options.add_argument("--disable-extensions")
+    options.add_argument("--disable-plugins")
+    options.add_argument("--blink-settings=imagesEnabled=false")  # Speed up loading
+    options.add_argument("--disable-javascript-harmony")
+    options.add_argument("--disable-web-security")
+    options.add_argument("--disable-ipc-flooding-protection")
+    options.add_argument(f"--user-agent={user_agent}")
+    options.add_argument("--window-size=1920,1080")
+    
+    # Skip first-run work and background services we never use
+    options.add_argument("--no-first-run")
+    options.add_argument("--no-default-browser-check")
+    options.add_argument("--disable-background-networking")
+    options.add_argument("--disable-component-update")
+    options.add_argument("--disable-default-apps")
+    options.add_argument("--disable-sync")
+    options.add_argument("--metrics-recording-only")
+    options.add_argument("--mute-audio")
+    options.add_argument("--disable-renderer-backgrounding")
+    options.add_argument("--disable-backgrounding-occluded-windows")
+    
+    if BROWSER_MAX_TABS > 1:
+        # Tabs that are not in front must keep their timers (waitFor, observers) running
+        options.add_argument("--disable-background-timer-throttling")
+    
+    if CHROME_LOW_MEMORY:
+        # Fewer renderer processes and a capped V8 heap / disk cache. Shared
+        # browsers keep one renderer per tab so heaps and hangs stay per tab.
+        options.add_argument("--disable-features=TranslateUI,OptimizationHints,MediaRouter,site-per-process")
+        options.add_argument(f"--renderer-process-limit={max(2, BROWSER_MAX_TABS)}")
+        options.add_argument(f"--js-flags=--max-old-space-size={CHROME_JS_HEAP_MB}")
+        options.add_argument(f"--disk-cache-size={CHROME_DISK_CACHE_MB * 1024 * 1024}")
+    else:
+        options.add_argument("--disable-features=TranslateUI")
+    
+    if user_data_dir:
+        options.add_argument(f"--user-data-dir={user_data_dir}")
+    
+    options.add_experimental_option("prefs", prefs)
+    return options
 
-def get_binary_version(binary_path):
-    """Get version of Chrome/ChromeDriver binary"""
-    try:
-        result = subprocess.run([binary_path, "--version"], capture_output=True, text=True, check=True)
-        return result.stdout.strip()
-    except Exception as e:
-        logging.error(f"❌ Could not determine version for {binary_path}", exc_info=True)
-        return f"Could not determine version: {e}"
+def prepare_profile_dir(session_id):
+    """Per-session --user-data-dir, cloned from CHROME_PROFILE_TEMPLATE on first use.
 
-def take_screenshot_in_memory(driver):
-    """Take full page screenshot"""
+    The directory is kept between restarts of the same session so cookies
+    and the HTTP cache survive reinitialization.
+    """
+    if not CHROME_PROFILE_ROOT:
+        return None
+    
+    profile_dir = os.path.join(CHROME_PROFILE_ROOT, f"session-{session_id}")
     try:
-        logging.info("📸 Capturing screenshot")
-        
-        # Get viewport dimensions
-        viewport_width = driver.execute_script("return window.innerWidth")
-        viewport_height = driver.execute_script("return window.innerHeight")
-        
-        # Get full page height
-        total_height = driver.execute_script("""
-            return Math.max(
-                document.body.scrollHeight,
-                document.body.offsetHeight,
-                document.documentElement.clientHeight,
-                document.documentElement.scrollHeight,
-                document.documentElement.offsetHeight
-            );
-        """)
-        
-        # Add buffer for floating elements
-        total_height = min(total_height + 200, 32767)  # Limit to prevent errors
-        
-        # Set window size for full capture
-        driver.set_window_size(viewport_width, total_height)
-        time.sleep(2)
+        if not os.path.isdir(profile_dir):
+            if CHROME_PROFILE_TEMPLATE and os.path.isdir(CHROME_PROFILE_TEMPLATE):
+                start = time.monotonic()
+                shutil.copytree(
+                    CHROME_PROFILE_TEMPLATE, profile_dir,
+                    ignore=shutil.ignore_patterns("Singleton*", "*.lock", "Crashpad")
+                )
+                logging.info(f"📂 Cloned profile template for session {session_id} in {time.monotonic() - start:.2f}s")
+            else:
+                os.makedirs(profile_dir, exist_ok=True)
         
-        # Take screenshot using CDP
-        screenshot_data = driver.execute_cdp_cmd("Page.captureScreenshot", {
-            "format": "png",
-            "fromSurface": True,
-            "captureBeyondViewport": True,
-            "clip": {
-                "width": viewport_width,
-                "height": total_height,
-                "x": 0,
-                "y": 0,
-                "scale": 1
+        # A previous Chrome that died uncleanly leaves lock files behind
+        for name in ("SingletonLock", "SingletonSocket", "SingletonCookie"):
+            path = os.path.join(profile_dir, name)
+            if os.path.lexists(path):
+                os.remove(path)
+        return profile_dir
+    except Exception:
+        logging.error(f"❌ Could not prepare profile directory {profile_dir}", exc_info=True)
+        return None
+
+
+class PhaseTimer:
+    """Collects wall-clock durations (ms) for the phases of one request"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = (time.monotonic() - start) * 1000
+            self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    def to_dict(self):
+        result = {f"{name}_ms": round(ms, 1) for name, ms in self.phases.items()}
+        result["total_ms"] = round((time.monotonic() - self.started) * 1000, 1)
+        return result
+
+
+class Deadline:
+    """Time budget of one request, from its ``deadline_ms`` parameter"""
+
+    def __init__(self, budget_ms):
+        self.budget_ms = budget_ms
+        self.expires_at = time.monotonic() + budget_ms / 1000
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def within_deadline(deadline, seconds):
+    """``seconds``, shortened to what is left of ``deadline`` (if any)"""
+    if deadline is None:
+        return seconds
+    return min(seconds, deadline.remaining())
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Metric:
+    """Base for the Prometheus text-format metrics served on /metrics"""
+
+    kind = "untyped"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Yield (suffix, labels, value) tuples"""
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items()) or [((), 0)]
+        return [("", labels, value) for labels, value in items]
+
+
+class Gauge(Metric):
+    """Gauge set directly or computed at scrape time by ``callback``.
+
+    A callback returns either a number or a list of (labels_dict, value).
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, callback=None):
+        super().__init__(name, help_text)
+        self.callback = callback
+        self._value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def samples(self):
+        if self.callback is None:
+            with self._lock:
+                return [("", (), self._value)]
+        value = self.callback()
+        if isinstance(value, list):
+            return [("", tuple(sorted(labels.items())), v) for labels, v in value]
+        return [("", (), value)]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def samples(self):
+        with self._lock:
+            series = [(k, dict(v, counts=list(v["counts"]))) for k, v in self._series.items()]
+        result = []
+        for labels, s in series:
+            for bound, count in zip(self.buckets, s["counts"]):
+                result.append(("_bucket", labels + (("le", bound),), count))
+            result.append(("_bucket", labels + (("le", "+Inf"),), s["count"]))
+            result.append(("_sum", labels, round(s["sum"], 6)))
+            result.append(("_count", labels, s["count"]))
+        return result
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(m.render() for m in self._metrics) + "\n"
+
+
+class PoolBusyError(Exception):
+    """Raised when no browser session can be checked out in time
+
+    ``retry_after`` (seconds) is set when the pool is merely overloaded,
+    and None when it is shutting down.
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DeadlineReached(Exception):
+    """Raised when a request's deadline runs out while the answer is generating
+
+    ``result`` is the unfinished wait result, with whatever text was read;
+    ``baseline_count`` the assistant message count from before the send.
+    """
+
+    def __init__(self, result, baseline_count=None):
+        super().__init__(result.get("error"))
+        self.result = result
+        self.baseline_count = baseline_count
+
+
+class BrowserSession:
+    """A single warm Chrome instance and its health state"""
+
+    def __init__(self, session_id):
+        self.id = session_id
+        self.driver = None
+        self.setup_complete = False
+        self.healthy = False
+        self.in_use = False
+        self.created_at = None
+        self.last_activity = None
+        self.last_health_check = None
+        self.last_error = None
+        self.request_count = 0
+        self.consecutive_failures = 0
+        self.failed_setups = 0
+        self.startup_timings = {}
+        self.cdp = None
+        self.stream_watcher = None
+        self.thread_owner = None
+        self.thread_turns = 0
+        self.checked_out_at = None
+        self.verified_at = None
+        self.needs_full_check = True
+        self.last_popup_at = None
+        self.memory = None
+        self.recycles = 0
+        self.last_recycle = None
+
+    def mark_health(self, healthy, error=None):
+        self.healthy = healthy
+        self.last_health_check = datetime.now()
+        if healthy:
+            self.consecutive_failures = 0
+            self.last_error = None
+            self.verified_at = time.monotonic()
+            self.needs_full_check = False
+        else:
+            self.needs_full_check = True
+            self.consecutive_failures += 1
+            if error:
+                self.last_error = str(error)
+
+    def record_outcome(self, ok):
+        """A clean answer proves the page works; anything else forces a full check next time"""
+        if ok:
+            self.verified_at = time.monotonic()
+            self.needs_full_check = False
+        else:
+            self.needs_full_check = True
+
+    def needs_verification(self):
+        return (self.needs_full_check or self.verified_at is None
+                or time.monotonic() - self.verified_at > HEALTH_RECHECK_IDLE_SECONDS)
+
+    def quit(self):
+        if self.cdp:
+            self.cdp.close()
+        self.cdp = None
+        self.stream_watcher = None
+        if self.driver:
+            try:
+                self.driver.quit()
+            except:
+                pass
+        self.driver = None
+        self.setup_complete = False
+        self.healthy = False
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "in_use": self.in_use,
+            "setup_complete": self.setup_complete,
+            "healthy": self.healthy,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "last_activity": self.last_activity.isoformat() if self.last_activity else None,
+            "last_health_check": self.last_health_check.isoformat() if self.last_health_check else None,
+            "last_error": self.last_error,
+            "verified_age_seconds": round(time.monotonic() - self.verified_at, 1) if self.verified_at else None,
+            "needs_full_check": self.needs_full_check,
+            "last_popup_at": self.last_popup_at.isoformat() if self.last_popup_at else None,
+            "request_count": self.request_count,
+            "consecutive_failures": self.consecutive_failures,
+            "failed_setups": self.failed_setups,
+            "startup_timings": self.startup_timings,
+            "cdp_connected": bool(self.cdp and self.cdp.alive),
+            "thread_owner": self.thread_owner,
+            "thread_turns": self.thread_turns,
+            "memory": self.memory,
+            "recycles": self.recycles,
+            "last_recycle": self.last_recycle
+        }
+
+
+class SessionPool:
+    """Fixed-size pool of browser sessions with checkout/checkin semantics.
+
+    Callers that find no idle session wait in a bounded queue; once
+    ``max_waiters`` callers are already waiting, or others are queued and
+    the estimated wait exceeds the caller's timeout, further checkouts fail
+    immediately with PoolBusyError.
+    """
+
+    def __init__(self, size, max_waiters, checkout_timeout):
+        self.size = max(1, size)
+        self.max_waiters = max_waiters
+        self.checkout_timeout = checkout_timeout
+        self.sessions = [BrowserSession(i) for i in range(self.size)]
+        self._idle = deque(self.sessions)
+        self._cond = threading.Condition()
+        self._waiters = 0
+        self._draining = False
+        self._hold_times = deque(maxlen=50)
+        self._reserved = set()
+
+    def warm(self):
+        """Start and set up every session in parallel"""
+        logging.info(f"🔥 Warming {self.size} browser session(s)...")
+        threads = [
+            threading.Thread(target=self._warm_one, args=(s,), name=f"warm-{s.id}", daemon=True)
+            for s in self.sessions
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ready = sum(1 for s in self.sessions if s.setup_complete)
+        logging.info(f"✅ {ready}/{self.size} browser session(s) ready")
+        return ready
+
+    def _warm_one(self, session):
+        try:
+            setup_chatgpt_session(session)
+        except Exception:
+            logging.error(f"❌ Session {session.id} failed to warm up")
+
+    def checkout(self, timeout=None, session_id=None):
+        """Take an idle session, waiting up to ``timeout`` seconds for one
+
+        With ``session_id`` the caller waits for that particular session,
+        e.g. the one holding a pinned conversation.
+        """
+        if timeout is None:
+            timeout = self.checkout_timeout
+
+        def candidates():
+            if session_id is None:
+                return [s for s in self._idle if s.id not in self._reserved]
+            return [s for s in self._idle if s.id == session_id and s.id not in self._reserved]
+
+        with self._cond:
+            if self._draining:
+                raise PoolBusyError("Server is shutting down")
+            if not candidates():
+                estimate = self._estimated_wait()
+                if self._waiters >= self.max_waiters:
+                    raise PoolBusyError(f"Wait queue full ({self._waiters} waiting)", estimate)
+                if self._waiters and estimate > timeout:
+                    raise PoolBusyError(f"Estimated wait {estimate:.0f}s exceeds {timeout:.0f}s", estimate)
+
+            deadline = time.monotonic() + timeout
+            self._waiters += 1
+            try:
+                while not candidates():
+                    if self._draining:
+                        raise PoolBusyError("Server is shutting down")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolBusyError(f"No browser session available after {timeout}s",
+                                            self._estimated_wait(ahead=self._waiters - 1))
+                    self._cond.wait(remaining)
+            finally:
+                self._waiters -= 1
+
+            # Prefer sessions that are known to be healthy
+            idle = candidates()
+            session = next((s for s in idle if s.healthy), idle[0])
+            self._idle.remove(session)
+            session.in_use = True
+            session.checked_out_at = time.monotonic()
+            return session
+
+    def checkin(self, session):
+        with self._cond:
+            session.in_use = False
+            # Health probes take sessions without checkout(); they are not timed
+            if session.checked_out_at is not None:
+                self._hold_times.append(time.monotonic() - session.checked_out_at)
+                session.checked_out_at = None
+            self._idle.append(session)
+            # Waiters may be pinned to different sessions
+            self._cond.notify_all()
+
+    def checkout_group(self, session_ids, timeout):
+        """Check out all of ``session_ids`` together, e.g. every tab of one browser
+
+        The sessions are reserved first, so no new request takes them while
+        the ones in use finish. Raises PoolBusyError after ``timeout``.
+        """
+        session_ids = set(session_ids)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._reserved |= session_ids
+            try:
+                while sum(1 for s in self._idle if s.id in session_ids) < len(session_ids):
+                    if self._draining:
+                        raise PoolBusyError("Server is shutting down")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolBusyError(f"Sessions {sorted(session_ids)} still busy after {timeout}s")
+                    self._cond.wait(remaining)
+                group = [s for s in self._idle if s.id in session_ids]
+                for s in group:
+                    self._idle.remove(s)
+                    s.in_use = True
+                return group
+            finally:
+                self._reserved -= session_ids
+                self._cond.notify_all()
+
+    def check_idle_sessions(self):
+        """Health-check idle sessions, taking only one out of rotation at a time
+
+        Probing (and the slower recycle maintenance) stops as soon as a
+        request is waiting for a session, so it never turns callers away.
+        """
+        for s in self.sessions:
+            with self._cond:
+                if self._waiters or self._draining:
+                    return
+                if s not in self._idle or not s.setup_complete or s.id in self._reserved:
+                    continue
+                self._idle.remove(s)
+                s.in_use = True
+            try:
+                if check_session_health(s):
+                    if not self._waiters:
+                        maintain_session(s)
+                    preposition_input(s)
+            finally:
+                self.checkin(s)
+
+    def drain(self, timeout):
+        """Stop handing out sessions and wait for checked-out ones to come back
+
+        Returns the number of sessions still in use after ``timeout`` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._draining = True
+            self._cond.notify_all()
+            while len(self._idle) < self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self.size - len(self._idle)
+
+    @property
+    def draining(self):
+        return self._draining
+
+    def typical_hold_time(self):
+        """Median seconds a session was held over the recent checkouts"""
+        with self._cond:
+            return self._typical_hold_time()
+
+    def _typical_hold_time(self):
+        if not self._hold_times:
+            return ADMISSION_DEFAULT_HOLD_SECONDS
+        return sorted(self._hold_times)[len(self._hold_times) // 2]
+
+    def _estimated_wait(self, ahead=None):
+        """Seconds until a new caller gets a session
+
+        Each checked-out session is expected back after the typical hold
+        time minus how long it has been held already; everyone queued ahead
+        of the caller (``ahead``, by default all waiters) takes one of those
+        first. Sessions held by health
+        probes are not timed and come back quickly, so they are ignored.
+        """
+        if self._idle:
+            return 0
+        now = time.monotonic()
+        typical = self._typical_hold_time()
+        remaining = sorted(
+            max(0.0, typical - (now - s.checked_out_at))
+            for s in self.sessions if s.in_use and s.checked_out_at is not None
+        )
+        if not remaining:
+            return 0
+        if ahead is None:
+            ahead = self._waiters
+        rounds, slot = divmod(ahead, len(remaining))
+        return remaining[slot] + rounds * typical
+
+    def close(self):
+        for s in self.sessions:
+            s.quit()
+
+    def stats(self):
+        with self._cond:
+            idle = len(self._idle)
+            waiters = self._waiters
+        return {
+            "size": self.size,
+            "idle": idle,
+            "in_use": self.size - idle,
+            "waiting": waiters,
+            "max_waiters": self.max_waiters,
+            "healthy": sum(1 for s in self.sessions if s.healthy),
+            "sessions": [s.to_dict() for s in self.sessions]
+        }
+
+
+class RateLimiter:
+    """Token bucket per client: ``rate_per_minute`` sustained, ``burst`` at once"""
+
+    def __init__(self, rate_per_minute, burst):
+        self.rate = rate_per_minute / 60
+        self.burst = max(1, burst)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def take(self, client, cost=1):
+        """Spend ``cost`` tokens; returns 0 on success, else seconds to wait"""
+        if not self.enabled:
+            return 0
+        # Larger requests (batches) need a full bucket and empty it
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= cost:
+                self._buckets[client] = (tokens - cost, now)
+                return 0
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > 10000:
+                self._prune(now)
+            return (cost - tokens) / self.rate
+
+    def _prune(self, now):
+        # A bucket that has had time to refill completely carries no state
+        full_after = self.burst / self.rate
+        self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < full_after}
+
+
+class HealthProber:
+    """Background thread that keeps the /status snapshot up to date.
+
+    Only idle sessions are probed, so probing never races with an /ask
+    that is using the same driver. Sessions that are busy report the
+    health recorded by their last request.
+    """
+
+    def __init__(self, pool, interval):
+        self.pool = pool
+        self.interval = interval
+        self._snapshot = None
+        self._taken_at = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="health-prober", daemon=True)
+        self._thread.start()
+        logging.info(f"🩺 Health prober running every {self.interval}s")
+
+    def stop(self):
+        self._stop.set()
+
+    def refresh(self):
+        try:
+            self.pool.check_idle_sessions()
+        except Exception:
+            logging.error("❌ Health probe failed", exc_info=True)
+
+        sessions = self.pool.sessions
+        activity = [s.last_activity for s in sessions if s.last_activity]
+        last_activity = max(activity) if activity else None
+        healthy = sum(1 for s in sessions if s.healthy)
+        snapshot = {
+            "status": "healthy" if healthy else "unhealthy",
+            "setup_complete": any(s.setup_complete for s in sessions),
+            "session_healthy": healthy > 0,
+            "healthy_sessions": healthy,
+            "last_activity": last_activity
+        }
+        with self._lock:
+            self._snapshot = snapshot
+            self._taken_at = time.time()
+
+    def snapshot(self):
+        """Return (snapshot, age_seconds), probing once if nothing is cached yet"""
+        with self._lock:
+            snapshot, taken_at = self._snapshot, self._taken_at
+        if snapshot is None:
+            self.refresh()
+            with self._lock:
+                snapshot, taken_at = self._snapshot, self._taken_at
+        return snapshot, time.time() - taken_at
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval)
+
+
+class JobQueueFullError(Exception):
+    """Raised when the job queue cannot accept more work"""
+
+
+class Job:
+    """A query submitted through /jobs and its eventual result"""
+
+    def __init__(self, query, conversation_id=None):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.conversation_id = conversation_id
+        self.state = "queued"
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.status_code = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.state,
+            "conversation_id": self.conversation_id,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "http_status": self.status_code,
+            "result": self.result
+        }
+
+    def finish(self, result, status_code):
+        self.result, self.status_code = result, status_code
+        self.state = "done"
+        self.finished_at = datetime.now()
+        self.done.set()
+
+
+class JobQueue:
+    """FIFO of pending jobs drained by background worker threads.
+
+    Workers run each job through execute_query, so they compete for
+    browser sessions exactly like /ask callers do. Finished jobs are kept
+    for ``retention`` seconds so clients can collect the result.
+    """
+
+    def __init__(self, workers, max_size, retention):
+        self.workers = max(1, workers)
+        self.max_size = max_size
+        self.retention = retention
+        self._pending = deque()
+        self._jobs = {}
+        self._running = 0
+        self._cond = threading.Condition()
+        self._threads = []
+        self._paused = False
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        logging.info(f"🧵 Started {self.workers} job worker(s)")
+
+    def pause(self):
+        """Let running jobs finish but start no new ones; returns the queue depth"""
+        with self._cond:
+            self._paused = True
+            return len(self._pending)
+
+    def submit(self, query, conversation_id=None):
+        self.start()
+        with self._cond:
+            self._prune()
+            if len(self._pending) >= self.max_size:
+                raise JobQueueFullError(f"{len(self._pending)} jobs already queued")
+            job = Job(query, conversation_id)
+            self._jobs[job.id] = job
+            self._pending.append(job)
+            self._cond.notify()
+            return job
+
+    def track(self, query, conversation_id=None):
+        """Register work that already runs elsewhere (e.g. an answer that
+        outlived its request's deadline) so /jobs/<id> can report it"""
+        with self._cond:
+            self._prune()
+            job = Job(query, conversation_id)
+            job.state = "running"
+            job.started_at = datetime.now()
+            self._jobs[job.id] = job
+            return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def position(self, job):
+        """1-based position in the queue, or 0 once the job has started"""
+        with self._cond:
+            try:
+                return self._pending.index(job) + 1
+            except ValueError:
+                return 0
+
+    def depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queue_depth": len(self._pending),
+                "running": self._running,
+                "workers": self.workers,
+                "max_size": self.max_size,
+                "tracked_jobs": len(self._jobs)
             }
-        })
 
-        screenshot_png = base64.b64decode(screenshot_data["data"])
-        logging.info(f"✅ Screenshot captured ({viewport_width}x{total_height}px)")
-        return screenshot_png
-        
-    except Exception as e:
-        logging.error("❌ Screenshot capture failed", exc_info=True)
-        # Fallback to regular screenshot
+    def _prune(self):
+        cutoff = time.time() - self.retention
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at and job.finished_at.timestamp() < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending or self._paused:
+                    self._cond.wait()
+                job = self._pending.popleft()
+                job.state = "running"
+                job.started_at = datetime.now()
+                self._running += 1
+
+            try:
+                result, status_code = execute_query(
+                    job.query, checkout_timeout=JOB_CHECKOUT_TIMEOUT, conversation_id=job.conversation_id
+                )
+            except Exception as e:
+                logging.error(f"❌ Job {job.id} failed", exc_info=True)
+                result, status_code = {"error": "Server error occurred", "details": str(e)}, 500
+            finally:
+                with self._cond:
+                    self._running -= 1
+                job.finish(result, status_code)
+                logging.info(f"📦 Job {job.id} finished with status {job.status_code}")
+
+
+class CdpChannel:
+    """Direct DevTools Protocol connection to one page target.
+
+    chromedriver only exposes CDP as request/response, so this opens a
+    second websocket to the same target. Commands are matched to replies by
+    id on a reader thread, and events are pushed to subscribers as
+    ``callback(method, params)``.
+    """
+
+    def __init__(self, ws_url):
+        if websocket is None:
+            raise RuntimeError("websocket-client is not installed")
+        self.ws_url = ws_url
+        self._ws = websocket.create_connection(ws_url, timeout=10, suppress_origin=True)
+        self._ws.settimeout(None)
+        self._send_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._pending = {}
+        self._listeners = {}
+        self._next_token = 0
+        self.alive = True
+        self._reader = threading.Thread(target=self._read_loop, name="cdp-reader", daemon=True)
+        self._reader.start()
+
+    @classmethod
+    def connect(cls, driver, target_id=None):
+        """Attach to the driver's current window (window handles are target ids)"""
+        address = driver.capabilities.get("goog:chromeOptions", {}).get("debuggerAddress")
+        if not address:
+            raise RuntimeError("Driver does not expose a debugger address")
+        target_id = target_id or driver.current_window_handle
+        return cls(f"ws://{address}/devtools/page/{target_id}")
+
+    def send(self, method, params=None, timeout=10):
+        if not self.alive:
+            raise RuntimeError("CDP channel closed")
+
+        waiter = {"done": threading.Event(), "message": None}
+        with self._lock:
+            self._next_id += 1
+            msg_id = self._next_id
+            self._pending[msg_id] = waiter
         try:
-            screenshot_png = driver.get_screenshot_as_png()
-            logging.info("✅ Fallback screenshot captured")
-            return screenshot_png
-        except:
-            raise e
+            with self._send_lock:
+                self._ws.send(json.dumps({"id": msg_id, "method": method, "params": params or {}}))
+            if not waiter["done"].wait(timeout):
+                raise TimeoutError(f"CDP {method} timed out after {timeout}s")
+        finally:
+            with self._lock:
+                self._pending.pop(msg_id, None)
 
-def dismiss_popups(timeout=10):
-    """Dismiss various popups that might appear"""
-    logging.info("🔍 Checking for popups to dismiss...")
+        message = waiter["message"]
+        if message is None:
+            raise RuntimeError("CDP channel closed")
+        if "error" in message:
+            raise RuntimeError(f"CDP {method} failed: {message['error'].get('message')}")
+        return message.get("result", {})
+
+    def evaluate(self, expression, timeout=10, await_promise=False):
+        """Runtime.evaluate returning the JSON value of the expression"""
+        result = self.send("Runtime.evaluate", {
+            "expression": expression,
+            "returnByValue": True,
+            "awaitPromise": await_promise
+        }, timeout)
+        if result.get("exceptionDetails"):
+            details = result["exceptionDetails"]
+            raise RuntimeError(details.get("exception", {}).get("description") or details.get("text"))
+        return result.get("result", {}).get("value")
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._next_token += 1
+            self._listeners[self._next_token] = callback
+            return self._next_token
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._listeners.pop(token, None)
+
+    def close(self):
+        self.alive = False
+        try:
+            self._ws.close()
+        except Exception:
+            pass
+
+    def _read_loop(self):
+        try:
+            while self.alive:
+                message = json.loads(self._ws.recv())
+                if "id" in message:
+                    with self._lock:
+                        waiter = self._pending.get(message["id"])
+                    if waiter:
+                        waiter["message"] = message
+                        waiter["done"].set()
+                elif "method" in message:
+                    with self._lock:
+                        listeners = list(self._listeners.values())
+                    for callback in listeners:
+                        try:
+                            callback(message["method"], message.get("params", {}))
+                        except Exception:
+                            logging.error("❌ CDP event handler failed", exc_info=True)
+        except Exception:
+            if self.alive:
+                logging.warning(f"⚠️ CDP channel disconnected: {self.ws_url}")
+        finally:
+            self.alive = False
+            with self._lock:
+                waiters = list(self._pending.values())
+            for waiter in waiters:
+                waiter["done"].set()
+
+
+class SharedBrowser:
+    """One Chrome process hosting several sessions as tabs.
+
+    WebDriver commands act on a single current window, so anything that
+    still goes through WebDriver switches windows under ``lock``. Window
+    handles are CDP target ids, which lets each TabDriver talk to its own
+    target directly instead.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.driver = None
+        self.lock = threading.RLock()
+        self.tabs = {}
+        self.current_handle = None
+        self.spare_handle = None
+        self.created_at = None
+        self.launches = 0
+        self.requests = 0
+        self.restart_reason = None
+        self._count_lock = threading.Lock()
+
+    def count_request(self):
+        with self._count_lock:
+            self.requests += 1
+
+    def alive(self):
+        if not self.driver:
+            return False
+        try:
+            self.driver.window_handles
+            return True
+        except Exception:
+            return False
+
+    def launch(self):
+        """(Re)start Chrome; tabs of a previous process are forgotten"""
+        self.quit()
+        profile_dir = prepare_profile_dir(f"browser-{self.index}")
+        self.driver = webdriver.Chrome(
+            service=Service(chromedriver_bin),
+            options=build_chrome_options(profile_dir)
+        )
+        self.driver.set_page_load_timeout(30)
+        self.driver.implicitly_wait(10)
+        # The window Chrome opens with becomes the first tab
+        self.current_handle = self.spare_handle = self.driver.current_window_handle
+        self.created_at = datetime.now()
+        self.launches += 1
+        self.requests = 0
+        logging.info(f"🚀 Browser {self.index}: Chrome launched for up to {BROWSER_MAX_TABS} tabs"
+                     f" (profile: {profile_dir or 'fresh'})")
+
+    def open_tab(self, session_id):
+        """Open a tab for ``session_id``, launching Chrome first if needed"""
+        with self.lock:
+            if not self.alive():
+                self.launch()
+            if self.spare_handle:
+                handle, self.spare_handle = self.spare_handle, None
+            else:
+                self._ensure_current()
+                handle = self.driver.execute_cdp_cmd("Target.createTarget", {"url": "about:blank"})["targetId"]
+            self.tabs[handle] = session_id
+            return TabDriver(self, handle)
+
+    def close_tab(self, handle, generation):
+        """Close one tab; Chrome itself is quit with its last tab"""
+        with self.lock:
+            # Tabs of an earlier Chrome process died with it
+            if generation != self.launches or self.tabs.pop(handle, None) is None:
+                return
+            if not self.tabs:
+                self.quit()
+                return
+            try:
+                if self.current_handle == handle:
+                    self.switch_to(next(iter(self.tabs)))
+                self.driver.execute_cdp_cmd("Target.closeTarget", {"targetId": handle})
+            except Exception:
+                logging.warning(f"⚠️ Browser {self.index}: could not close tab {handle}", exc_info=True)
+
+    def switch_to(self, handle):
+        """Make ``handle`` WebDriver's current window; call with ``lock`` held"""
+        if self.current_handle != handle:
+            self.driver.switch_to.window(handle)
+            self.current_handle = handle
+
+    def _ensure_current(self):
+        # Browser-wide CDP commands are sent through the current window
+        if self.current_handle not in self.tabs and self.tabs:
+            self.switch_to(next(iter(self.tabs)))
+
+    def quit(self):
+        with self.lock:
+            if self.driver:
+                try:
+                    self.driver.quit()
+                except Exception:
+                    pass
+            self.driver = None
+            self.tabs = {}
+            self.current_handle = self.spare_handle = None
+
+    def to_dict(self):
+        return {
+            "index": self.index,
+            "running": self.driver is not None,
+            "tabs": len(self.tabs),
+            "max_tabs": BROWSER_MAX_TABS,
+            "launches": self.launches,
+            "requests": self.requests,
+            "restart_pending": self.restart_reason,
+            "created_at": self.created_at.isoformat() if self.created_at else None
+        }
+
+
+class TabDriver:
+    """The subset of the WebDriver API the app uses, for one SharedBrowser tab.
+
+    Scripts, CDP commands and navigation go over the tab's own CDP
+    connection, so tabs never wait for each other. Only the remaining,
+    quick calls go through WebDriver after switching to this tab under the
+    browser lock. A tab whose CDP connection fails is not used: it would
+    hold that lock through every response wait and stall its sibling tabs.
+    """
+
+    def __init__(self, browser, handle):
+        self.browser = browser
+        self.handle = handle
+        self.generation = browser.launches
+        self.script_timeout = 30
+        self.page_load_timeout = 30
+        try:
+            self.channel = CdpChannel.connect(browser.driver, handle)
+            # Let background tabs behave like the focused one
+            self.channel.send("Emulation.setFocusEmulationEnabled", {"enabled": True})
+        except Exception as e:
+            browser.close_tab(handle, self.generation)
+            raise RuntimeError(f"Browser {browser.index}: no CDP connection to tab {handle}") from e
+
+    def _cdp(self):
+        if not self.channel.alive:
+            raise RuntimeError(f"Browser {self.browser.index}: CDP connection to tab {self.handle} lost")
+        return self.channel
+
+    def _webdriver(self, call):
+        with self.browser.lock:
+            if not self.browser.driver:
+                raise RuntimeError(f"Browser {self.browser.index} is not running")
+            self.browser.switch_to(self.handle)
+            return call(self.browser.driver)
+
+    def __getattr__(self, name):
+        if callable(getattr(webdriver.Chrome, name, None)):
+            return lambda *args, **kwargs: self._webdriver(lambda d: getattr(d, name)(*args, **kwargs))
+        return self._webdriver(lambda d: getattr(d, name))
+
+    @property
+    def capabilities(self):
+        return self.browser.driver.capabilities
+
+    @property
+    def current_window_handle(self):
+        return self.handle
+
+    @property
+    def current_url(self):
+        return self._cdp().evaluate("location.href")
+
+    @property
+    def title(self):
+        return self._cdp().evaluate("document.title")
+
+    def set_script_timeout(self, seconds):
+        # Applied per call; WebDriver's own timeouts are browser-wide
+        self.script_timeout = seconds
+
+    def set_page_load_timeout(self, seconds):
+        self.page_load_timeout = seconds
+
+    def execute_script(self, script, *args):
+        expression = f"(function() {{ {script}\n}}).apply(null, {json.dumps(list(args))})"
+        return self._cdp().evaluate(expression, timeout=self.script_timeout)
+
+    def execute_async_script(self, script, *args):
+        expression = (f"new Promise(resolve => {{ (function() {{ {script}\n}})"
+                      f".apply(null, {json.dumps(list(args))}.concat([resolve])); }})")
+        return self._cdp().evaluate(expression, timeout=self.script_timeout, await_promise=True)
+
+    def execute_cdp_cmd(self, cmd, params):
+        return self._cdp().send(cmd, params, timeout=self.script_timeout)
+
+    def get(self, url):
+        return self._load("Page.navigate", {"url": url})
+
+    def refresh(self):
+        return self._load("Page.reload", {})
+
+    def get_screenshot_as_png(self):
+        return base64.b64decode(self._cdp().send("Page.captureScreenshot", {"format": "png"}, timeout=30)["data"])
+
+    def _load(self, method, params):
+        """Navigate and block until the load event, like WebDriver's get()"""
+        timeout = self.page_load_timeout
+        channel = self._cdp()
+        loaded = threading.Event()
+        token = channel.subscribe(lambda event, _: event == "Page.loadEventFired" and loaded.set())
+        try:
+            channel.send("Page.enable")
+            channel.send(method, params, timeout)
+            if not loaded.wait(timeout):
+                raise TimeoutException(f"Page load did not finish within {timeout}s")
+        finally:
+            channel.unsubscribe(token)
+
+    def quit(self):
+        self.channel.close()
+        self.browser.close_tab(self.handle, self.generation)
+
+
+class ConversationStreamWatcher:
+    """Follows the conversation's event-stream request through CDP Network events.
+
+    Network.loadingFinished on that request is an authoritative end of
+    generation; the SSE frames are decoded into a best-effort copy of the
+    answer text. Call reset() before each send.
+    """
+
+    def __init__(self, channel, url_pattern):
+        self.url_pattern = url_pattern
+        self._lock = threading.Lock()
+        self.reset()
+        channel.subscribe(self._on_event)
+
+    def reset(self):
+        with self._lock:
+            self.request_id = None
+            self.text = ""
+            self.frames = 0
+            self.finished = threading.Event()
+
+    def _on_event(self, method, params):
+        if method == "Network.responseReceived":
+            response = params.get("response", {})
+            if self.url_pattern in response.get("url", "") and "event-stream" in response.get("mimeType", ""):
+                with self._lock:
+                    self.request_id = params.get("requestId")
+                    self.text = ""
+                    self.frames = 0
+            return
+
+        if self.request_id is None or params.get("requestId") != self.request_id:
+            return
+
+        if method == "Network.eventSourceMessageReceived":
+            with self._lock:
+                self.frames += 1
+                self.text = apply_stream_frame(self.text, params.get("data", ""))
+        elif method in ("Network.loadingFinished", "Network.loadingFailed"):
+            self.finished.set()
+
+
+def apply_stream_frame(text, data):
+    """Best-effort decode of one conversation SSE frame into the answer so far.
+
+    Understands full-message frames (``message.content.parts``) and the
+    incremental ``{"p": ..., "o": "append", "v": ...}`` patch frames.
+    Anything else leaves the text unchanged.
+    """
+    if not data or data == "[DONE]":
+        return text
+    try:
+        frame = json.loads(data)
+    except ValueError:
+        return text
+    if not isinstance(frame, dict):
+        return text
+
+    value = frame.get("v")
+    message = frame.get("message")
+    if message is None and isinstance(value, dict):
+        message = value.get("message")
+    if isinstance(message, dict):
+        if message.get("author", {}).get("role") == "assistant":
+            parts = message.get("content", {}).get("parts") or []
+            if parts and isinstance(parts[0], str):
+                return parts[0]
+        return text
+
+    path = frame.get("p", "/message/content/parts/0")
+    if isinstance(value, str) and frame.get("o", "append") == "append" and path.endswith("/parts/0"):
+        return text + value
+    if isinstance(value, list) and frame.get("o") == "patch":
+        for op in value:
+            if (isinstance(op, dict) and op.get("o") == "append" and isinstance(op.get("v"), str)
+                    and str(op.get("p", "")).endswith("/parts/0")):
+                text += op["v"]
+    return text
+
+
+class Conversation:
+    """A client conversation pinned to one session's chat thread"""
+
+    def __init__(self, conversation_id, session_id):
+        self.id = conversation_id
+        self.session_id = session_id
+        self.thread_url = None
+        self.turns = 0
+        self.last_used = time.time()
+
+
+class ConversationRegistry:
+    """conversation_id -> Conversation, forgotten after ``ttl`` idle seconds"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._conversations = {}
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id):
+        with self._lock:
+            self._prune()
+            conversation = self._conversations.get(conversation_id)
+            if conversation:
+                conversation.last_used = time.time()
+            return conversation
+
+    def create(self, conversation_id, session_id):
+        with self._lock:
+            conversation = self._conversations[conversation_id] = Conversation(conversation_id, session_id)
+            return conversation
+
+    def stats(self):
+        with self._lock:
+            return {"active": len(self._conversations), "max_turns": CONVERSATION_MAX_TURNS}
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        for conversation_id in [c.id for c in self._conversations.values() if c.last_used < cutoff]:
+            del self._conversations[conversation_id]
+
+
+class ScreenshotCache:
+    """Tiny TTL cache of encoded screenshots keyed on the request options"""
+
+    def __init__(self, ttl, max_entries=8):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                return None
+            return entry[0]
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class ResponseCache:
+    """LRU + TTL cache of successful /ask payloads keyed on the normalized query.
+
+    Entries live in memory (at most ``max_entries``) and, when ``db_path``
+    is set, in an SQLite table so they survive restarts. Memory misses fall
+    through to SQLite and promote the entry back into memory.
+    """
+
+    def __init__(self, enabled, max_entries, ttl, db_path=None, db_max_entries=10000):
+        self.enabled = enabled
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        self.db_max_entries = db_max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes = 0
+
+        if enabled and db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False)
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS response_cache "
+                    "(key TEXT PRIMARY KEY, payload TEXT NOT NULL, created REAL NOT NULL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS response_cache_created ON response_cache (created)")
+                self._db.commit()
+                logging.info(f"💾 Response cache persisted to {db_path}")
+            except Exception:
+                logging.error(f"❌ Could not open cache database {db_path}", exc_info=True)
+                self._db = None
+
+    def get(self, key):
+        """Return (payload, age_seconds) for a fresh entry, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and now - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None and self._db:
+                row = self._db.execute(
+                    "SELECT payload, created FROM response_cache WHERE key = ? AND created >= ?",
+                    (key, now - self.ttl)
+                ).fetchone()
+                if row:
+                    entry = (row[0], row[1])
+                    self._store(key, entry)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return json.loads(entry[0]), now - entry[1]
+
+    def set(self, key, payload):
+        entry = (json.dumps(payload), time.time())
+        with self._lock:
+            self._store(key, entry)
+            if self._db:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO response_cache (key, payload, created) VALUES (?, ?, ?)",
+                        (key, entry[0], entry[1])
+                    )
+                    self._writes += 1
+                    if self._writes % 100 == 0:
+                        self._prune_db()
+                    self._db.commit()
+                except Exception:
+                    logging.error("❌ Failed to write cache entry to disk", exc_info=True)
+
+    def flush(self):
+        """Drop every entry from both tiers and return how many were in memory"""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            if self._db:
+                self._db.execute("DELETE FROM response_cache")
+                self._db.commit()
+            return count
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "persistent": self._db is not None,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune_db(self):
+        self._db.execute("DELETE FROM response_cache WHERE created < ?", (time.time() - self.ttl,))
+        self._db.execute(
+            "DELETE FROM response_cache WHERE key NOT IN "
+            "(SELECT key FROM response_cache ORDER BY created DESC LIMIT ?)",
+            (self.db_max_entries,)
+        )
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one execution.
+
+    The first caller for a key runs the function; callers arriving while
+    it is in flight block and receive the same result (or exception).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+            self.followers = 0
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Return (result, shared); ``shared`` is True for followers"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                call.followers += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "waiting_followers": sum(c.followers for c in self._calls.values())
+            }
+
+
+def normalize_query(query):
+    """Cache key for a query: whitespace-collapsed and case-folded"""
+    return " ".join(query.split()).casefold()
+
+def initialize_driver(session):
+    """Initialize Chrome driver for a session with error handling"""
+    if BROWSER_MAX_TABS > 1:
+        return open_session_tab(session)
+    try:
+        session.quit()
+        start = time.monotonic()
+        profile_dir = prepare_profile_dir(session.id)
+        # Each driver needs its own chromedriver process; quitting one
+        # driver stops its Service
+        session.driver = webdriver.Chrome(
+            service=Service(chromedriver_bin),
+            options=build_chrome_options(profile_dir)
+        )
+        session.driver.set_page_load_timeout(30)
+        session.driver.implicitly_wait(10)
+        install_agent(session.driver)
+        session.created_at = datetime.now()
+        session.request_count = 0
+        session.startup_timings = {"launch_ms": round((time.monotonic() - start) * 1000)}
+        logging.info(f"⏱️ Session {session.id}: Chrome launched in {session.startup_timings['launch_ms']}ms"
+                     f" (profile: {profile_dir or 'fresh'})")
+        if CDP_TRANSPORT:
+            connect_cdp(session)
+        return True
+    except Exception as e:
+        logging.error(f"❌ Failed to initialize driver for session {session.id}", exc_info=True)
+        return False
+
+def open_session_tab(session):
+    """initialize_driver for shared browsers: give the session a fresh tab
+
+    Only the tab is replaced; Chrome is launched here only when it is gone.
+    A tab that keeps failing setup (TAB_MAX_FAILURES) asks for a restart
+    of its browser once the sibling tabs are drained.
+    """
+    browser = browser_of(session)
+    if TAB_MAX_FAILURES and session.failed_setups >= TAB_MAX_FAILURES:
+        request_browser_restart(browser, f"session {session.id} failed setup {session.failed_setups} times")
+    try:
+        session.quit()
+        start = time.monotonic()
+        session.driver = browser.open_tab(session.id)
+        install_agent(session.driver)
+        session.created_at = datetime.now()
+        session.request_count = 0
+        session.startup_timings = {"launch_ms": round((time.monotonic() - start) * 1000)}
+        logging.info(f"⏱️ Session {session.id}: tab opened in browser {browser.index} "
+                     f"in {session.startup_timings['launch_ms']}ms")
+        if CDP_TRANSPORT:
+            connect_cdp(session)
+        return True
+    except Exception:
+        logging.error(f"❌ Failed to open a tab for session {session.id}", exc_info=True)
+        return False
+
+def browser_of(session):
+    """The SharedBrowser hosting ``session``'s tab, or None without shared browsers"""
+    return browsers[session.id // BROWSER_MAX_TABS] if browsers else None
+
+def request_browser_restart(browser, reason):
+    """Relaunch a shared browser in the background once none of its tabs is in use"""
+    with browser.lock:
+        if browser.restart_reason:
+            return
+        browser.restart_reason = reason
+    logging.info(f"♻️ Browser {browser.index}: restart requested ({reason}), draining its tabs")
+    threading.Thread(target=restart_browser_when_idle, args=(browser,),
+                     name=f"browser-restart-{browser.index}", daemon=True).start()
+
+def restart_browser_when_idle(browser):
+    """Take every tab of ``browser`` out of the pool, relaunch Chrome and set them up again"""
+    ids = [s.id for s in pool.sessions if browser_of(s) is browser]
+    try:
+        sessions = pool.checkout_group(ids, REQUEST_TIMEOUT)
+    except PoolBusyError as e:
+        logging.warning(f"⚠️ Browser {browser.index}: restart postponed ({e})")
+        browser.restart_reason = None
+        return
+    try:
+        session_recycles_total.inc(action="browser_restart")
+        logging.info(f"♻️ Browser {browser.index}: relaunching ({browser.restart_reason})")
+        browser.quit()
+        for s in sessions:
+            s.failed_setups = 0
+            s.recycles += 1
+            try:
+                setup_chatgpt_session(s)
+            except Exception:
+                logging.error(f"❌ Session {s.id}: setup failed after browser restart")
+    finally:
+        browser.restart_reason = None
+        for s in sessions:
+            pool.checkin(s)
+
+def connect_cdp(session):
+    """Open the CDP event channel for a session; falls back to WebDriver on failure"""
+    try:
+        channel = CdpChannel.connect(session.driver)
+        channel.send("Runtime.addBinding", {"name": CDP_BINDING_NAME})
+        channel.send("Network.enable")
+        session.stream_watcher = ConversationStreamWatcher(channel, CDP_STREAM_URL_PATTERN)
+        session.cdp = channel
+        logging.info(f"🔌 Session {session.id}: CDP event channel connected")
+    except Exception:
+        logging.warning(f"⚠️ Session {session.id}: CDP event channel unavailable, using WebDriver polling", exc_info=True)
+        session.cdp = None
+        session.stream_watcher = None
+
+def get_binary_version(binary_path):
+    """Get version of Chrome/ChromeDriver binary"""
+    try:
+        result = subprocess.run([binary_path, "--version"], capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except Exception as e:
+        logging.error(f"❌ Could not determine version for {binary_path}", exc_info=True)
+        return f"Could not determine version: {e}"
+
+binary_versions = None
+
+def get_binary_versions():
+    """Chrome and ChromeDriver versions, looked up once per process"""
+    global binary_versions
+    if binary_versions is None:
+        binary_versions = {
+            "chrome": get_binary_version(chrome_bin),
+            "driver": get_binary_version(chromedriver_bin)
+        }
+    return binary_versions
+
+PAGE_SIZE_JS = """
+    return [
+        Math.max(document.documentElement.scrollWidth, window.innerWidth),
+        Math.max(document.body.scrollHeight, document.documentElement.scrollHeight, window.innerHeight),
+        window.innerWidth,
+        window.innerHeight
+    ];
+"""
+
+def parse_screenshot_options(args):
+    """Validate /api/screenshot query parameters; raises ValueError"""
+    fmt = args.get("format", "png").lower().replace("jpg", "jpeg")
+    if fmt not in SCREENSHOT_FORMATS:
+        raise ValueError(f"format must be one of {sorted(SCREENSHOT_FORMATS)}")
+    quality = int(args.get("quality", "80"))
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    scale = float(args.get("scale", "1"))
+    if not 0.05 <= scale <= 2:
+        raise ValueError("scale must be between 0.05 and 2")
+    max_width = int(args["max_width"]) if args.get("max_width") else None
+    if max_width is not None and max_width <= 0:
+        raise ValueError("max_width must be a positive integer")
+    
+    tiled = args.get("tiled", "auto").lower()
+    if tiled not in ("auto", "1", "true", "yes", "0", "false", "no"):
+        raise ValueError("tiled must be auto, 1 or 0")
+    
+    clip = args.get("clip", "full")
+    if clip not in ("full", "viewport"):
+        parts = [float(v) for v in clip.split(",")]
+        if len(parts) != 4 or parts[2] <= 0 or parts[3] <= 0:
+            raise ValueError("clip must be full, viewport or x,y,width,height")
+        clip = tuple(parts)
+    
+    return {
+        "format": fmt,
+        "quality": quality,
+        "scale": scale,
+        "max_width": max_width,
+        "clip": clip,
+        "tiled": tiled
+    }
+
+def take_screenshot_in_memory(driver, options):
+    """Capture a screenshot through CDP without resizing the window
+
+    ``captureBeyondViewport`` renders off-screen parts directly, so the
+    live session's viewport is never touched. Returns encoded bytes, or
+    ``(tiles, width, height, scale)`` with PNG tiles to be stitched by
+    stitch_screenshot_tiles.
+    """
+    logging.info(f"📸 Capturing screenshot ({options})")
+    page_width, page_height, viewport_width, viewport_height = driver.execute_script(PAGE_SIZE_JS)
+    
+    clip = options["clip"]
+    if clip == "full":
+        x, y, width, height = 0, 0, page_width, min(page_height, SCREENSHOT_MAX_HEIGHT)
+    elif clip == "viewport":
+        x, y = driver.execute_script("return [window.scrollX, window.scrollY]")
+        width, height = viewport_width, viewport_height
+    else:
+        x, y, width, height = clip
+        height = min(height, SCREENSHOT_MAX_HEIGHT)
+    
+    scale = options["scale"]
+    if options["max_width"] and width * scale > options["max_width"]:
+        scale = options["max_width"] / width
+    
+    tiled = options["tiled"] in ("1", "true", "yes") or (options["tiled"] == "auto" and height > SCREENSHOT_TILE_HEIGHT)
+    
+    def capture(tile_y, tile_height, fmt, quality=None):
+        params = {
+            "format": fmt,
+            "fromSurface": True,
+            "captureBeyondViewport": True,
+            "clip": {"x": x, "y": tile_y, "width": width, "height": tile_height, "scale": scale}
+        }
+        if quality is not None and fmt != "png":
+            params["quality"] = quality
+        return base64.b64decode(driver.execute_cdp_cmd("Page.captureScreenshot", params)["data"])
+    
+    try:
+        if not tiled:
+            data = capture(y, height, options["format"], options["quality"])
+            logging.info(f"✅ Screenshot captured ({width}x{height}px at scale {scale:.2f}, {len(data)} bytes)")
+            return data
+        
+        tiles = []
+        for offset in range(0, int(height), SCREENSHOT_TILE_HEIGHT):
+            tile_height = min(SCREENSHOT_TILE_HEIGHT, height - offset)
+            tiles.append((offset, capture(y + offset, tile_height, "png")))
+        logging.info(f"✅ Screenshot captured in {len(tiles)} tile(s) ({width}x{height}px)")
+        return tiles, round(width * scale), round(height * scale), scale
+        
+    except Exception as e:
+        logging.error("❌ Screenshot capture failed", exc_info=True)
+        # Fallback to a plain viewport screenshot, re-encoded as requested
+        try:
+            screenshot_png = driver.get_screenshot_as_png()
+            logging.info("✅ Fallback screenshot captured")
+            with Image.open(BytesIO(screenshot_png)) as image:
+                return [(0, screenshot_png)], image.width, image.height, 1
+        except:
+            raise e
+
+def stitch_screenshot_tiles(tiles, width, height, scale, options):
+    """Paste PNG tiles into one image and encode it (after the session is checked in)"""
+    canvas = Image.new("RGB", (width, height), "white")
+    for offset, data in tiles:
+        with Image.open(BytesIO(data)) as tile:
+            canvas.paste(tile.convert("RGB"), (0, round(offset * scale)))
+    return encode_image(canvas, options)
+
+def encode_image(image, options):
+    out = BytesIO()
+    if options["format"] == "png":
+        image.save(out, "PNG", optimize=False)
+    else:
+        image.save(out, options["format"].upper(), quality=options["quality"])
+    return out.getvalue()
+
+def wait_for_chat_input(driver, timeout):
+    """Block until the chat input exists, for at most ``timeout`` seconds"""
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=0.25).until(
+            lambda d: agent_call(d, "agent.inputPresent()")
+        )
+        return True
+    except TimeoutException:
+        return False
+
+def dismiss_popups(driver, timeout=POPUP_SETTLE_TIMEOUT):
+    """Dismiss various popups that might appear
+
+    Returns immediately when nothing is found. After each click it waits
+    (at most ``timeout`` seconds) for the popup to disappear before
+    looking for another one.
+    """
+    logging.info("🔍 Checking for popups to dismiss...")
+    
+    try:
+        dismissed_any = False
+        for attempt in range(3):
+            if not agent_call(driver, "agent.dismiss()"):
+                break
+            
+            dismissed_any = True
+            logging.info(f"✅ Popup dismissed on attempt {attempt + 1}")
+            try:
+                WebDriverWait(driver, timeout, poll_frequency=0.1).until(
+                    lambda d: not agent_call(d, "agent.popupVisible()")
+                )
+            except TimeoutException:
+                pass
+        
+        if not dismissed_any:
+            logging.info("ℹ️ No popups found to dismiss")
+        return dismissed_any
+        
+    except Exception as e:
+        logging.error("❌ Error while dismissing popups", exc_info=True)
+        return False
+
+def preposition_input(session):
+    """Resolve and focus the input of an idle session ahead of its next send"""
+    try:
+        agent_call(session.driver, "agent.prepare()")
+    except Exception:
+        logging.debug(f"Session {session.id}: could not pre-position the input", exc_info=True)
+
+def verify_session(session):
+    """Full health check when due, otherwise one agent.health() call
+
+    Returns (healthy, sweep_popups): a full check is followed by the
+    complete popup sweep, the sentinel only asks for one when it saw a
+    popup.
+    """
+    if session.needs_verification():
+        return check_session_health(session), True
+    
+    try:
+        state = agent_call(session.driver, "agent.health()")
+    except Exception as e:
+        logging.warning(f"⚠️ Session {session.id}: sentinel failed ({e}), running full health check")
+        return check_session_health(session), True
+    
+    if not (state["ready"] and state["input"] and state["host"] and state["host"].lower() in CHAT_URL.lower()):
+        logging.info(f"🩺 Session {session.id}: sentinel reported {state}, running full health check")
+        return check_session_health(session), True
+    if state["popup"]:
+        session.last_popup_at = datetime.now()
+    return True, state["popup"]
+
+def check_session_health(session):
+    """Check if the given session is healthy and record the result"""
+    driver = session.driver
+    if not driver:
+        session.mark_health(False, "Driver not initialized")
+        return False
+
+    try:
+        # Test basic page interaction
+        title = driver.title
+        url = driver.current_url
+        
+        # Check if we're still on ChatGPT
+        if CHAT_URL.split("://")[-1].lower() not in url.lower():
+            logging.warning(f"⚠️ Session {session.id} not on ChatGPT page: {url}")
+            session.mark_health(False, f"Not on ChatGPT page: {url}")
+            return False
+            
+        # Check the page is responsive and shows the chat interface
+        state = agent_call(driver, "agent.health()")
+        
+        if not state["input"]:
+            logging.warning(f"⚠️ Session {session.id}: no input element found")
+            session.mark_health(False, "No input element found")
+            return False
+            
+        logging.debug(f"✅ Session {session.id} health check passed")
+        session.mark_health(True)
+        return True
+        
+    except Exception as e:
+        logging.error(f"❌ Session {session.id} health check failed", exc_info=True)
+        session.mark_health(False, e)
+        return False
+
+def setup_chatgpt_session(session, deadline=None):
+    """Setup ChatGPT session with enhanced error handling
+
+    With a ``deadline`` the navigation and every wait are cut to the time
+    left (Chrome launch itself is not).
+    """
+    session_reinits_total.inc()
+    setup_start = time.monotonic()
+    try:
+        if not initialize_driver(session):
+            raise Exception("Failed to initialize driver")
+            
+        driver = session.driver
+        timings = session.startup_timings
+        logging.info(f"🌐 Session {session.id}: navigating to ChatGPT...")
+        step = time.monotonic()
+        navigate(driver, CHAT_URL, deadline)
+        
+        # Wait for initial page load
+        WebDriverWait(driver, within_deadline(deadline, 20)).until(
+            lambda d: d.execute_script("return document.readyState") == "complete"
+        )
+        timings["navigate_ms"] = round((time.monotonic() - step) * 1000)
+        
+        logging.info("⏳ Waiting for chat input to render...")
+        step = time.monotonic()
+        if not wait_for_chat_input(driver, within_deadline(deadline, SETUP_READY_TIMEOUT)):
+            logging.warning(f"⚠️ Session {session.id}: chat input not rendered after {SETUP_READY_TIMEOUT}s")
+        timings["render_ms"] = round((time.monotonic() - step) * 1000)
+        
+        # Dismiss any popups
+        step = time.monotonic()
+        dismiss_popups(driver, within_deadline(deadline, POPUP_SETTLE_TIMEOUT))
+        timings["popups_ms"] = round((time.monotonic() - step) * 1000)
+        
+        # Verify we have the chat interface
+        if not check_session_health(session):
+            raise Exception("Chat interface not available")
+            
+        preposition_input(session)
+        session.failed_setups = 0
+        session.setup_complete = True
+        session.last_activity = datetime.now()
+        session.thread_owner = None
+        session.thread_turns = 0
+        timings["total_ms"] = round((time.monotonic() - setup_start) * 1000)
+        logging.info(f"✅ Session {session.id}: ChatGPT session setup completed in {timings['total_ms']}ms ({timings})")
+        
+        return True
+        
+    except Exception as e:
+        logging.error(f"❌ Session {session.id}: failed to setup ChatGPT session", exc_info=True)
+        session.failed_setups += 1
+        session.setup_complete = False
+        session.mark_health(False, e)
+        raise
+
+NEW_CHAT_JS = """
+    const button = document.querySelector('[data-testid="create-new-chat-button"], a[href="/"]');
+    if (button && button.offsetParent !== null) {
+        button.click();
+        return true;
+    }
+    return false;
+"""
+
+EMPTY_THREAD_JS = """
+    return document.querySelectorAll('[data-message-author-role]').length === 0;
+"""
+
+def navigate(driver, url, deadline=None):
+    """Load ``url``, with the page-load timeout cut to what is left of ``deadline``"""
+    driver.set_page_load_timeout(max(within_deadline(deadline, 30), 0.1))
+    try:
+        driver.get(url)
+    finally:
+        driver.set_page_load_timeout(30)
+
+def start_new_thread(session, deadline=None):
+    """Open a fresh chat: in-app "new chat" first, full navigation as fallback"""
+    driver = session.driver
+    try:
+        if driver.execute_script(NEW_CHAT_JS):
+            WebDriverWait(driver, within_deadline(deadline, 5), poll_frequency=0.1).until(
+                lambda d: d.execute_script(EMPTY_THREAD_JS) and agent_call(d, "agent.inputPresent()")
+            )
+            logging.info(f"🆕 Session {session.id}: started a new chat thread")
+            return
+    except TimeoutException:
+        pass
+    
+    navigate(driver, CHAT_URL, deadline)
+    wait_for_chat_input(driver, within_deadline(deadline, SETUP_READY_TIMEOUT))
+    logging.info(f"🆕 Session {session.id}: navigated to a new chat thread")
+
+def open_thread(session, thread_url, deadline=None):
+    """Navigate to an existing chat thread"""
+    navigate(session.driver, thread_url, deadline)
+    wait_for_chat_input(session.driver, within_deadline(deadline, SETUP_READY_TIMEOUT))
+    logging.info(f"🧵 Session {session.id}: reopened thread {thread_url}")
+
+def select_thread(session, conversation, deadline=None):
+    """Put the session on the chat thread this request belongs to
+
+    Requests without a conversation share an anonymous thread per session;
+    conversations get their own. Any thread is replaced by a fresh one once
+    it reaches CONVERSATION_MAX_TURNS. Navigation and waits are cut to what
+    is left of ``deadline``.
+    """
+    owner = conversation.id if conversation else None
+    turns = conversation.turns if conversation else session.thread_turns
+    
+    if turns >= CONVERSATION_MAX_TURNS:
+        logging.info(f"♻️ Session {session.id}: rotating thread after {turns} turns")
+        start_new_thread(session, deadline)
+        if conversation:
+            conversation.thread_url = None
+            conversation.turns = 0
+    elif owner != session.thread_owner:
+        if conversation and conversation.thread_url:
+            open_thread(session, conversation.thread_url, deadline)
+        else:
+            start_new_thread(session, deadline)
+    else:
+        return
+    
+    session.thread_owner = owner
+    session.thread_turns = 0
+
+def record_turn(session, conversation):
+    """Count a completed turn and remember the thread URL of new conversations"""
+    session.thread_turns += 1
+    if conversation:
+        conversation.turns += 1
+        if not conversation.thread_url:
+            url = session.driver.current_url
+            if url.rstrip("/") != CHAT_URL.rstrip("/"):
+                conversation.thread_url = url
+
+MEMORY_FALLBACK_JS = """
+    const memory = performance.memory || {};
+    return {
+        JSHeapUsedSize: memory.usedJSHeapSize || 0,
+        JSHeapTotalSize: memory.totalJSHeapSize || 0,
+        Nodes: document.getElementsByTagName('*').length
+    };
+"""
+
+def read_session_memory(session):
+    """Sample the renderer's JS heap and DOM size and store them on the session"""
+    driver = session.driver
+    try:
+        driver.execute_cdp_cmd("Performance.enable", {})
+        values = {m["name"]: m["value"] for m in driver.execute_cdp_cmd("Performance.getMetrics", {})["metrics"]}
+    except Exception:
+        values = driver.execute_script(MEMORY_FALLBACK_JS)
+    
+    session.memory = {
+        "heap_used_mb": round(values.get("JSHeapUsedSize", 0) / 2**20, 1),
+        "heap_total_mb": round(values.get("JSHeapTotalSize", 0) / 2**20, 1),
+        "dom_nodes": int(values.get("Nodes", 0)),
+        "sampled_at": datetime.now().isoformat()
+    }
+    return session.memory["heap_used_mb"]
+
+def collect_garbage(driver):
+    try:
+        driver.execute_cdp_cmd("HeapProfiler.collectGarbage", {})
+    except Exception:
+        pass
+
+def recycle_session(session, reason, action):
+    """Record a reclamation step; "restart" relaunches Chrome (reopens the tab in a shared browser)"""
+    heap = (session.memory or {}).get("heap_used_mb")
+    logging.info(f"♻️ Session {session.id}: {action} ({reason}, heap {heap}MB, {session.request_count} requests)")
+    session_recycles_total.inc(action=action)
+    session.last_recycle = {"action": action, "reason": reason, "heap_used_mb": heap, "at": datetime.now().isoformat()}
+    if action == "restart":
+        session.recycles += 1
+        setup_chatgpt_session(session)
+
+def recycle_limit_reason(requests, created_at):
+    """Why the RECYCLE_MAX_REQUESTS / RECYCLE_MAX_AGE_MINUTES limits call for a restart, or None"""
+    age_minutes = (datetime.now() - created_at).total_seconds() / 60 if created_at else 0
+    if RECYCLE_MAX_REQUESTS and requests >= RECYCLE_MAX_REQUESTS:
+        return f"{requests} requests"
+    if RECYCLE_MAX_AGE_MINUTES and age_minutes >= RECYCLE_MAX_AGE_MINUTES:
+        return f"{age_minutes:.0f} minutes old"
+    return None
+
+def maintain_session(session):
+    """Apply the recycle policy to an idle, checked-out session
+
+    Cheap steps come first: a fresh chat thread drops the conversation DOM,
+    a reload drops the page's heap. Chrome is only restarted when those do
+    not bring the heap under RECYCLE_HEAP_MB, or when the request or age
+    limits are reached. For shared browsers those limits apply to the
+    whole Chrome process, which is restarted once all its tabs are idle;
+    the heap steps (including "restart") only affect this tab.
+    """
+    browser = browser_of(session)
+    try:
+        if browser:
+            reason = recycle_limit_reason(browser.requests, browser.created_at)
+            if reason:
+                return request_browser_restart(browser, reason)
+        else:
+            reason = recycle_limit_reason(session.request_count, session.created_at)
+            if reason:
+                return recycle_session(session, reason, "restart")
+        
+        heap = read_session_memory(session)
+        logging.debug(f"🧠 Session {session.id} memory: {session.memory}")
+        
+        if RECYCLE_SOFT_HEAP_MB and heap >= RECYCLE_SOFT_HEAP_MB and (session.thread_turns or session.thread_owner):
+            recycle_session(session, f"heap {heap}MB", "new_thread")
+            start_new_thread(session)
+            session.thread_owner = None
+            session.thread_turns = 0
+            collect_garbage(session.driver)
+            heap = read_session_memory(session)
+        
+        if RECYCLE_HEAP_MB and heap >= RECYCLE_HEAP_MB:
+            recycle_session(session, f"heap {heap}MB", "reload")
+            session.driver.refresh()
+            wait_for_chat_input(session.driver, SETUP_READY_TIMEOUT)
+            dismiss_popups(session.driver)
+            collect_garbage(session.driver)
+            heap = read_session_memory(session)
+        
+        if RECYCLE_HEAP_MB and heap >= RECYCLE_HEAP_MB:
+            recycle_session(session, f"heap {heap}MB after reload", "restart")
+    except Exception as e:
+        logging.error(f"❌ Session {session.id}: memory maintenance failed", exc_info=True)
+        session.mark_health(False, e)
+
+def send_message_to_chatgpt(driver, message, deadline=None):
+    """Send message to ChatGPT through the in-page agent
+
+    Fast path: the agent focuses its cached input, CDP Input.insertText
+    types the text the way a keyboard would, and the agent clicks send and
+    waits for the user message to appear. Anything unexpected falls back to
+    the all-JavaScript agent.send(). Scripts get at most what is left of
+    ``deadline``.
+    """
+    driver.set_script_timeout(max(within_deadline(deadline, 30), 0.1))
+    try:
+        ready = agent_call(driver, "agent.prepare()")
+        if not ready.get("ready"):
+            return {"success": False, "error": ready.get("error")}
+        driver.execute_cdp_cmd("Input.insertText", {"text": message})
+        result = agent_call_async(driver, "agent.submit(arguments[0])", message)
+        if result.get("error") == "Failed to set message text":
+            logging.info("ℹ️ Input.insertText did not reach the input, retyping via JavaScript")
+            result = agent_call_async(driver, "agent.send(arguments[0])", message)
+    except Exception:
+        logging.warning("⚠️ Fast send path failed, falling back to agent.send()", exc_info=True)
+        result = agent_call_async(driver, "agent.send(arguments[0])", message)
+    
+    if result.get("success") and not result.get("confirmed"):
+        logging.warning("⚠️ Send clicked but no new user message appeared within 2s")
+    return result
+
+# Response extraction helpers, part of the in-page agent below
+EXTRACT_RESPONSE_JS = """
+    const assistantSelectors = [
+        '[data-message-author-role="assistant"]',
+        '[data-testid*="assistant"]',
+        '.group.w-full.text-token-text-primary',
+        '[role="presentation"] > div > div'
+    ];
+    
+    function findLastMessage() {
+        for (const selector of assistantSelectors) {
+            const messages = document.querySelectorAll(selector);
+            if (messages.length > 0) return messages[messages.length - 1];
+        }
+        return null;
+    }
+    
+    function countMessages() {
+        for (const selector of assistantSelectors) {
+            const count = document.querySelectorAll(selector).length;
+            if (count > 0) return count;
+        }
+        return 0;
+    }
+    
+    function isGenerating() {
+        const stopSelectors = [
+            'button[data-testid="stop-button"]',
+            'button[aria-label*="Stop"]'
+        ];
+        return stopSelectors.some(sel => document.querySelector(sel) !== null);
+    }
+    
+    // Filter out navigation and UI elements
+    const filterPatterns = [
+        /^Copy code$/,
+        /^Share$/,
+        /^Regenerate$/,
+        /^Stop generating$/,
+        /^ChatGPT/
+    ];
+    
+    function cleanLines(text) {
+        return text.split('\\n').filter(line => {
+            const trimmed = line.trim();
+            return trimmed.length > 0 && !filterPatterns.some(pattern => pattern.test(trimmed));
+        }).join('\\n').trim();
+    }
+    
+    function isLoading(message) {
+        if (message.querySelector('.result-thinking, .loading, .spinner, [data-testid*="loading"], .animate-pulse')) {
+            return true;
+        }
+        // Placeholder text before the first token; only worth checking while short
+        const text = message.childElementCount === 0 || (message.textContent || '').length < 40
+            ? (message.textContent || '').trim().toLowerCase()
+            : '';
+        return text === '...' || text.startsWith('thinking') || text.startsWith('typing');
+    }
+    
+    // Kept on window between calls: finished blocks are converted to text
+    // once, and only the trailing (still growing) block is re-read
+    if (!window.__responseExtractor) {
+        window.__responseExtractor = {
+            message: null,
+            container: null,
+            doneNodes: [],
+            prefix: '',
+            cursors: {},
+            
+            reset(message, container) {
+                this.message = message;
+                this.container = container;
+                this.doneNodes = [];
+                this.prefix = '';
+            },
+            
+            findContainer(message) {
+                let container = message.querySelector('.markdown') || message;
+                while (container.children.length === 1 && container.firstElementChild.tagName === 'DIV') {
+                    container = container.firstElementChild;
+                }
+                return container;
+            },
+            
+            blockText(node) {
+                const tag = node.tagName ? node.tagName.toLowerCase() : '';
+                if (tag === 'pre') {
+                    const code = node.querySelector('code');
+                    const langClass = code ? Array.from(code.classList).find(c => c.startsWith('language-')) : null;
+                    const lang = langClass ? langClass.slice('language-'.length) : '';
+                    const body = ((code || node).textContent || '').replace(/\\n$/, '');
+                    return '```' + lang + '\\n' + body + '\\n```';
+                }
+                
+                let text;
+                if (/^h[1-6]$/.test(tag)) {
+                    text = '#'.repeat(Number(tag[1])) + ' ' + node.textContent.trim();
+                } else if (tag === 'ul' || tag === 'ol') {
+                    text = Array.from(node.children)
+                        .map((li, i) => (tag === 'ol' ? (i + 1) + '. ' : '- ') + li.textContent.trim())
+                        .join('\\n');
+                } else if (tag === 'blockquote') {
+                    text = node.textContent.trim().split('\\n').map(line => '> ' + line).join('\\n');
+                } else if (tag === 'table') {
+                    text = Array.from(node.querySelectorAll('tr'))
+                        .map(tr => Array.from(tr.children).map(cell => cell.textContent.trim()).join(' | '))
+                        .join('\\n');
+                } else if (tag === 'hr') {
+                    text = '---';
+                } else {
+                    text = node.textContent || '';
+                }
+                return cleanLines(text);
+            },
+            
+            text(message) {
+                if (message !== this.message || !this.container || !this.container.isConnected ||
+                        this.container === message) {
+                    const container = this.findContainer(message);
+                    if (message !== this.message || container !== this.container) {
+                        this.reset(message, container);
+                    }
+                }
+                
+                const blocks = this.container.children;
+                if (blocks.length === 0) {
+                    return cleanLines(this.container.textContent || '');
+                }
+                
+                // A re-render replaced blocks we already converted: start over
+                const done = this.doneNodes.length;
+                if (done > blocks.length - 1 || (done > 0 &&
+                        (blocks[0] !== this.doneNodes[0] || blocks[done - 1] !== this.doneNodes[done - 1]))) {
+                    this.reset(message, this.container);
+                }
+                
+                while (this.doneNodes.length < blocks.length - 1) {
+                    const node = blocks[this.doneNodes.length];
+                    const text = this.blockText(node);
+                    this.doneNodes.push(node);
+                    if (text) this.prefix += (this.prefix ? '\\n' : '') + text;
+                }
+                
+                const tail = this.blockText(blocks[blocks.length - 1]);
+                return tail ? (this.prefix ? this.prefix + '\\n' + tail : tail) : this.prefix;
+            },
+            
+            // Text plus what changed since the last read by the same cursor
+            read(message, cursor) {
+                const text = this.text(message);
+                const previous = this.cursors[cursor];
+                this.cursors[cursor] = { message: message, text: text };
+                if (previous && previous.message === message && text.startsWith(previous.text)) {
+                    return { text: text, delta: text.slice(previous.text.length), reset: false };
+                }
+                return { text: text, delta: text, reset: true };
+            }
+        };
+    }
+    
+    function extractResponse() {
+        const lastMessage = findLastMessage();
+        if (!lastMessage || isLoading(lastMessage)) return null;
+        return window.__responseExtractor.text(lastMessage);
+    }
+    
+    // Like extractResponse(), but also reports the delta since the previous
+    // call with the same cursor name
+    function extractResponseDelta(cursor) {
+        const lastMessage = findLastMessage();
+        if (!lastMessage || isLoading(lastMessage)) return null;
+        return window.__responseExtractor.read(lastMessage, cursor);
+    }
+"""
+
+# In-page runtime shared by every WebDriver and CDP call. It is installed once
+# per document via Page.addScriptToEvaluateOnNewDocument, so each call only
+# ships a short expression such as "agent.send(arguments[0])". The version is
+# a hash of the source: pages running an older copy reinstall it.
+AGENT_JS_TEMPLATE = """
+(() => {
+    if (window.__agent && window.__agent.version === '__AGENT_VERSION__') return;
+""" + EXTRACT_RESPONSE_JS + """
+    // Present once the chat input has rendered
+    const presenceSelectors = [
+        '[contenteditable="true"]',
+        'textarea',
+        '#prompt-textarea',
+        '[data-testid="textbox"]'
+    ];
+    
+    const inputSelectors = [
+        '[contenteditable="true"]',
+        '#prompt-textarea',
+        'textarea[placeholder*="Message"]',
+        '[data-testid="textbox"]',
+        '.ProseMirror[contenteditable="true"]'
+    ];
+    
+    const sendSelectors = [
+        'button[data-testid="send-button"]',
+        'button[aria-label*="Send"]',
+        '[data-testid="fruitjuice-send-button"]',
+        'button svg[data-testid*="send"]',
+        'form button[type="submit"]',
+        'button:has(svg)'
+    ];
+    
+    const popupSelectors = ['[role="dialog"]', '.modal', '.popup', '.overlay'];
+    
+    // Resolve with predicate() as soon as it is truthy, or with the last
+    // value once timeoutMs has passed
+    const waitFor = (predicate, timeoutMs) => new Promise(resolve => {
+        const start = Date.now();
+        const check = () => {
+            const value = predicate();
+            if (value || Date.now() - start >= timeoutMs) resolve(value);
+            else setTimeout(check, 50);
+        };
+        check();
+    });
+    
+    // Element references survive between calls; any structural DOM change
+    // forces a fresh selector scan on next use
+    const elements = { input: null, sendButton: null, dirty: true, observer: null };
+    
+    function usable(el) {
+        return el && el.isConnected && el.offsetParent !== null && !el.disabled && !el.readOnly;
+    }
+    
+    function cached(name, find) {
+        if (!elements.observer && document.body) {
+            elements.observer = new MutationObserver(() => { elements.dirty = true; });
+            elements.observer.observe(document.body, { childList: true, subtree: true });
+        }
+        if (elements.dirty) {
+            elements.input = null;
+            elements.sendButton = null;
+            elements.dirty = false;
+        }
+        if (!usable(elements[name])) elements[name] = find();
+        return elements[name];
+    }
+    
+    function findInput() {
+        for (const selector of inputSelectors) {
+            for (const el of document.querySelectorAll(selector)) {
+                if (el.offsetParent !== null && !el.disabled && !el.readOnly) return el;
+            }
+        }
+        return null;
+    }
+    
+    function findSendButton() {
+        for (const selector of sendSelectors) {
+            for (const btn of document.querySelectorAll(selector)) {
+                if (btn.offsetParent !== null && !btn.disabled) return btn;
+            }
+        }
+        
+        // Try finding by proximity to input
+        const input = cached('input', findInput);
+        if (!input) return null;
+        const box = input.getBoundingClientRect();
+        return Array.from(document.querySelectorAll('button')).find(btn =>
+            btn.offsetParent !== null &&
+            !btn.disabled &&
+            btn.getBoundingClientRect().top > box.top - 100 &&
+            btn.getBoundingClientRect().top < box.bottom + 100
+        ) || null;
+    }
+    
+    function inputPresent() {
+        return presenceSelectors.some(sel => document.querySelector(sel) !== null);
+    }
+    
+    function popupVisible() {
+        return popupSelectors.some(sel =>
+            Array.from(document.querySelectorAll(sel)).some(el => el.offsetParent !== null));
+    }
+    
+    function dismiss() {
+        let dismissed = false;
+        const popupSelectors = [
+            // Stay logged out popup
+            'a[href*="logout"]',
+            'button:contains("Stay logged out")',
+            'a:contains("Stay logged out")',
+        
+            // Modal close buttons
+            '[data-testid*="close"]',
+            '.modal button[aria-label="Close"]',
+            'button[aria-label="Close"]',
+        
+            // Cookie banners
+            'button:contains("Accept")',
+            'button:contains("OK")',
+        
+            // Other common popups
+            '[role="dialog"] button',
+            '.popup button',
+            '.overlay button'
+        ];
+    
+        // Try text-based selectors
+        const textSelectors = [
+            "Stay logged out",
+            "Accept all",
+            "Continue",
+            "Got it",
+            "OK",
+            "Close"
+        ];
+    
+        for (const text of textSelectors) {
+            const elements = Array.from(document.querySelectorAll('button, a, [role="button"]'))
+                .filter(el => el.textContent.trim().toLowerCase().includes(text.toLowerCase()));
+        
+            for (const el of elements) {
+                if (el.offsetParent !== null) { // Check if visible
+                    el.click();
+                    dismissed = true;
+                    break;
+                }
+            }
+            if (dismissed) break;
+        }
+    
+        // Try selector-based dismissal
+        if (!dismissed) {
+            for (const selector of popupSelectors) {
+                try {
+                    const element = document.querySelector(selector);
+                    if (element && element.offsetParent !== null) {
+                        element.click();
+                        dismissed = true;
+                        break;
+                    }
+                } catch (e) { /* ignore */ }
+            }
+        }
+    
+        return dismissed;
+    }
+    
+    function isTextarea(input) {
+        return input.tagName.toLowerCase() === 'textarea';
+    }
+    
+    function inputText(input) {
+        return isTextarea(input) ? input.value : input.textContent || input.innerText || '';
+    }
+    
+    function userMessageCount() {
+        return document.querySelectorAll('[data-message-author-role="user"]').length;
+    }
+    
+    // Focus and clear the cached input so text can be inserted straight away
+    // (by CDP Input.insertText, or typeInto as the fallback)
+    function prepare() {
+        const input = cached('input', findInput);
+        if (!input) {
+            return { ready: false, error: "No input element found" };
+        }
+        if (document.activeElement !== input) input.focus();
+        if (inputText(input)) {
+            if (isTextarea(input)) {
+                input.value = '';
+            } else {
+                input.innerHTML = '';
+                input.textContent = '';
+            }
+            input.dispatchEvent(new Event('input', { bubbles: true }));
+        }
+        return { ready: true };
+    }
+    
+    function typeInto(input, message) {
+        if (isTextarea(input)) {
+            input.value = message;
+            input.dispatchEvent(new Event('input', { bubbles: true }));
+            input.dispatchEvent(new Event('change', { bubbles: true }));
+        } else {
+            // For contenteditable elements
+            input.textContent = message;
+            input.dispatchEvent(new Event('input', { bubbles: true }));
+        }
+    }
+    
+    // Click send once the text is in, then wait for the page to show the
+    // new user message (or start generating) instead of a fixed delay
+    async function submit(message) {
+        const input = cached('input', findInput);
+        if (!input) {
+            return { success: false, error: "No input element found" };
+        }
+        const textSet = await waitFor(() => inputText(input).includes(message.substring(0, 50)), 500);
+        if (!textSet) {
+            return { success: false, error: "Failed to set message text" };
+        }
+        
+        // The send button is enabled once the app has processed the input
+        const before = userMessageCount();
+        const sendButton = await waitFor(() => cached('sendButton', findSendButton), 2000);
+        if (!sendButton || sendButton.disabled) {
+            return { success: false, error: "Send button not found or disabled" };
+        }
+        sendButton.click();
+        
+        const confirmed = await waitFor(
+            () => userMessageCount() > before || isGenerating() || !inputText(input).trim(), 2000);
+        return { success: true, message: "Message sent successfully", confirmed: !!confirmed };
+    }
+    
+    async function send(message) {
+        try {
+            // Wait for page to be ready
+            await waitFor(() => document.readyState === 'complete', 10000);
+            
+            const ready = prepare();
+            if (!ready.ready) {
+                return { success: false, error: ready.error };
+            }
+            typeInto(cached('input', findInput), message);
+            return await submit(message);
+            
+        } catch (error) {
+            return { success: false, error: "JavaScript error: " + error.toString() };
+        }
+    }
+    
+    // Resolves once the answer is complete: a MutationObserver waits for
+    // quietWindow ms without changes, polling is the fallback
+    // baselineCount is the number of assistant messages before sending;
+    // nothing counts as the answer until a newer message exists
+    function waitDone(maxWaitTime, checkInterval, requiredStableChecks, quietWindow, baselineCount) {
+        const answered = () => baselineCount == null || countMessages() > baselineCount;
+        return new Promise(callback => {
+            const startTime = Date.now();
+            let lastResponse = "";
+            let stableChecks = 0;
+            let finished = false;
+            let sawActivity = false;
+            let quietTimer = null;
+            let pollTimer = null;
+            let observer = null;
+    
+            function finish(result) {
+                if (finished) return;
+                finished = true;
+                if (observer) observer.disconnect();
+                clearTimeout(quietTimer);
+                clearTimeout(pollTimer);
+                result.waitTime = Date.now() - startTime;
+                callback(result);
+            }
+    
+            // Event-driven path: resolve once generation stopped and the DOM is quiet
+            function onQuiet() {
+                if (finished || !sawActivity || isGenerating() || !answered()) return;
+                const currentResponse = extractResponse();
+                if (currentResponse && currentResponse.length > 0) {
+                    finish({ success: true, response: currentResponse, detectedBy: "observer" });
+                }
+            }
+    
+            function onMutations(mutations) {
+                const lastMessage = findLastMessage();
+                const relevant = mutations.some(m => {
+                    const target = m.target.nodeType === Node.ELEMENT_NODE ? m.target : m.target.parentElement;
+                    if (!target) return false;
+                    return (lastMessage && lastMessage.contains(target)) ||
+                           target.closest('button') !== null ||
+                           Array.from(m.addedNodes).some(n => n.nodeType === Node.ELEMENT_NODE &&
+                               (n.matches('button') || n.querySelector('button, [data-message-author-role]')));
+                });
+                if (!relevant) return;
+        
+                sawActivity = true;
+                clearTimeout(quietTimer);
+                quietTimer = setTimeout(onQuiet, quietWindow);
+            }
+    
+            // Fallback path: poll until the text is stable for several reads
+            function checkForResponse() {
+                if (finished) return;
+                if (isGenerating()) sawActivity = true;
+                const currentResponse = answered() ? extractResponse() : null;
+        
+                if (currentResponse && currentResponse.length > 0) {
+                    if (currentResponse === lastResponse) {
+                        stableChecks++;
+                        if (stableChecks >= requiredStableChecks && !isGenerating()) {
+                            finish({ success: true, response: currentResponse, detectedBy: "poll" });
+                            return;
+                        }
+                    } else {
+                        stableChecks = 0;
+                        lastResponse = currentResponse;
+                    }
+                }
+        
+                const elapsedTime = Date.now() - startTime;
+                if (elapsedTime > maxWaitTime) {
+                    finish({
+                        success: false,
+                        response: (answered() && extractResponse()) || lastResponse || null,
+                        error: "Timeout waiting for response"
+                    });
+                    return;
+                }
+        
+                pollTimer = setTimeout(checkForResponse, checkInterval);
+            }
+    
+            observer = new MutationObserver(onMutations);
+            observer.observe(document.body, {
+                childList: true,
+                subtree: true,
+                characterData: true,
+                attributes: true,
+                attributeFilter: ['disabled', 'data-testid', 'aria-label']
+            });
+            checkForResponse();
+        });
+    }
+    
+    // Reports text changes and completion through the CDP binding instead
+    // of a held-open script
+    function watch(quietWindow, binding) {
+        if (window.__cdpWatchStop) window.__cdpWatchStop();
+        const emit = (message) => window[binding](JSON.stringify(message));
+        const initialCount = countMessages();
+        const initialText = extractResponse();
+        let lastSent = null;
+        let sawActivity = false;
+        let quietTimer = null;
+        let throttle = null;
+    
+        function sample() {
+            throttle = null;
+            if (isGenerating()) sawActivity = true;
+            const update = extractResponseDelta('cdp');
+            // Still looking at the previous answer
+            if (!update || !update.text || (countMessages() <= initialCount && update.text === initialText)) return;
+            sawActivity = true;
+            if (update.text !== lastSent) {
+                // First report after install is always the full text
+                const reset = update.reset || lastSent === null;
+                emit({ type: 'text', delta: reset ? update.text : update.delta, reset: reset });
+                lastSent = update.text;
+            }
+        }
+    
+        function onQuiet() {
+            sample();
+            if (!sawActivity || isGenerating() || !lastSent) return;
+            emit({ type: 'done', text: lastSent });
+            window.__cdpWatchStop();
+        }
+    
+        const observer = new MutationObserver(() => {
+            if (!throttle) throttle = setTimeout(sample, 100);
+            clearTimeout(quietTimer);
+            quietTimer = setTimeout(onQuiet, quietWindow);
+        });
+        observer.observe(document.body, {
+            childList: true,
+            subtree: true,
+            characterData: true,
+            attributes: true,
+            attributeFilter: ['disabled', 'data-testid', 'aria-label']
+        });
+        window.__cdpWatchStop = () => {
+            observer.disconnect();
+            clearTimeout(quietTimer);
+            clearTimeout(throttle);
+            window.__cdpWatchStop = null;
+        };
+        sample();
+    }
+    
+    window.__agent = {
+        version: '__AGENT_VERSION__',
+        inputPresent: inputPresent,
+        popupVisible: popupVisible,
+        dismiss: dismiss,
+        prepare: prepare,
+        submit: submit,
+        send: send,
+        waitDone: waitDone,
+        watch: watch,
+        extract: extractResponse,
+        health() {
+            return {
+                host: location.host,
+                ready: document.readyState === 'complete',
+                input: inputPresent(),
+                popup: popupVisible()
+            };
+        },
+        count: countMessages,
+        snapshot(cursor) {
+            const update = extractResponseDelta(cursor);
+            return {
+                delta: update ? update.delta : null,
+                reset: update ? update.reset : false,
+                generating: isGenerating(),
+                count: countMessages()
+            };
+        }
+    };
+})();
+"""
+AGENT_VERSION = hashlib.sha1(AGENT_JS_TEMPLATE.encode()).hexdigest()[:12]
+AGENT_JS = AGENT_JS_TEMPLATE.replace("__AGENT_VERSION__", AGENT_VERSION)
+AGENT_MISSING = "__agent_missing__"
+AGENT_GUARD_JS = f"const agent = window.__agent; if (!agent || agent.version !== '{AGENT_VERSION}') "
+
+def install_agent(driver):
+    """Register the agent for every future document and install it in the current one"""
+    try:
+        driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": AGENT_JS})
+    except Exception:
+        logging.warning("⚠️ Could not register the in-page agent; it will be installed on demand", exc_info=True)
+    driver.execute_script(AGENT_JS)
+
+def agent_call(driver, expression, *args):
+    """Evaluate ``expression`` against the in-page agent, e.g. "agent.health()"
+
+    If the page lost the agent (or runs an outdated copy) it is reinstalled
+    once and the call retried.
+    """
+    script = AGENT_GUARD_JS + f"return '{AGENT_MISSING}'; return {expression};"
+    result = driver.execute_script(script, *args)
+    if result == AGENT_MISSING:
+        driver.execute_script(AGENT_JS)
+        result = driver.execute_script(script, *args)
+    return result
+
+def agent_call_async(driver, expression, *args):
+    """Like agent_call, for agent methods that return a Promise"""
+    script = (
+        "const done = arguments[arguments.length - 1]; "
+        + AGENT_GUARD_JS + f"{{ done('{AGENT_MISSING}'); return; }} "
+        + f"Promise.resolve({expression}).then(done, error => done({{ success: false, error: 'JavaScript error: ' + error }}));"
+    )
+    result = driver.execute_async_script(script, *args)
+    if result == AGENT_MISSING:
+        driver.execute_script(AGENT_JS)
+        result = driver.execute_async_script(script, *args)
+    return result
+
+def ensure_agent_cdp(channel):
+    """Install the agent over a CDP channel if the page does not have it"""
+    present = channel.evaluate(f"!!(window.__agent && window.__agent.version === '{AGENT_VERSION}')")
+    if not present:
+        channel.evaluate(AGENT_JS)
+
+def wait_for_response(driver, timeout=RESPONSE_TIMEOUT, baseline_count=None):
+    """Wait for ChatGPT response, resolving as soon as the page goes quiet
+
+    A MutationObserver watches the last assistant message and the stop/send
+    button. Once generation has been seen and nothing changes for
+    RESPONSE_QUIET_MS, the answer is returned. Polling every
+    RESPONSE_POLL_INTERVAL_MS with RESPONSE_STABLE_CHECKS identical reads
+    remains as a fallback. With ``baseline_count`` (assistant messages
+    before the send) the previous answer is never mistaken for the new one.
+    """
+    
+    driver.set_script_timeout(timeout + max(REQUEST_TIMEOUT - RESPONSE_TIMEOUT, 5))
+    result = agent_call_async(
+        driver,
+        "agent.waitDone(arguments[0], arguments[1], arguments[2], arguments[3], arguments[4])",
+        int(timeout * 1000),
+        RESPONSE_POLL_INTERVAL_MS,
+        RESPONSE_STABLE_CHECKS,
+        RESPONSE_QUIET_MS,
+        baseline_count
+    )
+    
+    return result
+
+def read_response_snapshot(driver):
+    """Read what changed in the assistant message and the generation state in one round trip
+
+    Only the delta since the previous snapshot travels over the wire; when
+    ``reset`` is true the delta is the full text.
+    """
+    return agent_call(driver, "agent.snapshot('snapshot')")
+
+def cdp_response_updates(session, timeout=None):
+    """Yield ("text", full_text) as the answer grows, then ("done", result).
+
+    Text and completion come from the in-page observer via
+    Runtime.bindingCalled. If the conversation's network stream finishes
+    first, the DOM gets one quiet window to catch up before it is read.
+    ``result`` has the same shape as wait_for_response's.
+    """
+    channel = session.cdp
+    watcher = session.stream_watcher
+    timeout = RESPONSE_TIMEOUT if timeout is None else timeout
+    updates = queue.Queue()
+
+    def on_event(method, params):
+        if method == "Runtime.bindingCalled" and params.get("name") == CDP_BINDING_NAME:
+            updates.put(params.get("payload"))
+
+    token = channel.subscribe(on_event)
+    start = time.monotonic()
+    last_text = ""
+    network_done_at = None
+    try:
+        ensure_agent_cdp(channel)
+        channel.evaluate(f"window.__agent.watch({RESPONSE_QUIET_MS}, '{CDP_BINDING_NAME}')")
+        while True:
+            elapsed = time.monotonic() - start
+            wait_time = int(elapsed * 1000)
+            if not channel.alive:
+                raise RuntimeError("CDP channel closed while waiting for response")
+            if elapsed > timeout:
+                yield "done", {
+                    "success": False,
+                    "response": last_text or (watcher.text if watcher else "") or None,
+                    "error": "Timeout waiting for response",
+                    "waitTime": wait_time
+                }
+                return
+
+            try:
+                payload = json.loads(updates.get(timeout=0.1))
+            except queue.Empty:
+                payload = None
+
+            if payload:
+                if payload.get("type") == "text":
+                    delta = payload.get("delta") or ""
+                    last_text = delta if payload.get("reset") else last_text + delta
+                else:
+                    last_text = payload.get("text") or last_text
+                if payload.get("type") == "done":
+                    yield "done", {"success": True, "response": last_text, "waitTime": wait_time, "detectedBy": "cdp-binding"}
+                    return
+                yield "text", last_text
+                continue
+
+            if watcher and watcher.finished.is_set():
+                if network_done_at is None:
+                    network_done_at = time.monotonic()
+                elif (time.monotonic() - network_done_at) * 1000 >= RESPONSE_QUIET_MS:
+                    text = channel.evaluate("window.__agent.extract()") or watcher.text
+                    if text:
+                        yield "done", {"success": True, "response": text, "waitTime": wait_time, "detectedBy": "cdp-network"}
+                        return
+    finally:
+        channel.unsubscribe(token)
+        try:
+            if channel.alive:
+                channel.evaluate("window.__cdpWatchStop && window.__cdpWatchStop()")
+        except Exception:
+            pass
+
+def poll_response_updates(driver, baseline_count, timeout=None):
+    """WebDriver fallback for cdp_response_updates: sample every STREAM_POLL_INTERVAL_MS"""
+    timeout = RESPONSE_TIMEOUT if timeout is None else timeout
+    start_time = time.time()
+    quiet_seconds = RESPONSE_QUIET_MS / 1000
+    last_text = ""
+    saw_activity = False
+    last_change = time.time()
+    
+    text = ""
+    
+    while True:
+        snapshot = read_response_snapshot(driver)
+        # Ignore the previous answer until the new message node exists
+        if snapshot.get("count", 0) > baseline_count and snapshot.get("delta") is not None:
+            text = snapshot["delta"] if snapshot.get("reset") else text + snapshot["delta"]
+        generating = snapshot.get("generating")
+        if generating:
+            saw_activity = True
+        
+        if text and text != last_text:
+            saw_activity = True
+            last_change = time.time()
+            last_text = text
+            yield "text", text
+        
+        wait_time = int((time.time() - start_time) * 1000)
+        
+        if saw_activity and last_text and not generating and time.time() - last_change >= quiet_seconds:
+            yield "done", {"success": True, "response": last_text, "waitTime": wait_time, "detectedBy": "poll"}
+            return
+        
+        if wait_time > timeout * 1000:
+            yield "done", {
+                "success": False,
+                "response": last_text or None,
+                "error": "Timeout waiting for response",
+                "waitTime": wait_time
+            }
+            return
+        
+        time.sleep(STREAM_POLL_INTERVAL_MS / 1000)
+
+def count_assistant_messages(driver):
+    """Assistant messages on the page; read before sending as the wait baseline"""
+    return agent_call(driver, "agent.count()")
+
+def wait_for_session_response(session, timeout=RESPONSE_TIMEOUT, baseline_count=None):
+    """Wait for the answer over the CDP channel when available, else WebDriver"""
+    start = time.monotonic()
+    if session.cdp and session.cdp.alive:
+        try:
+            for kind, value in cdp_response_updates(session, timeout):
+                if kind == "done":
+                    return value
+        except Exception:
+            logging.warning(f"⚠️ Session {session.id}: CDP wait failed, falling back to WebDriver", exc_info=True)
+    return wait_for_response(session.driver, max(0.0, timeout - (time.monotonic() - start)), baseline_count)
+
+def continue_in_background(session, query, conversation, result, timer, baseline_count=None):
+    """Hand a session whose request ran out of time to a background thread
+
+    The thread waits for the rest of the answer, stores it as a job (and
+    in the cache, for plain queries) and only then checks the session in.
+    Returns the job; the caller must not check the session in itself.
+    """
+    job = jobs.track(query, conversation.id if conversation else None)
+    remaining = max(RESPONSE_TIMEOUT - result.get("waitTime", 0) / 1000, 1)
+    logging.info(f"⏩ Deadline reached, finishing the answer in background job {job.id}")
+    
+    def finish():
+        payload, status_code, ok = None, 500, False
+        try:
+            final = wait_for_response(session.driver, remaining, baseline_count)
+            text = final.get("response") or result.get("response")
+            metadata = {"session_id": session.id, "continued_from_deadline": True, "phases": timer.to_dict()}
+            if conversation:
+                metadata["conversation_id"] = conversation.id
+                metadata["conversation_turn"] = conversation.turns
+            if final.get("success") and text:
+                ok = True
+                session.last_activity = datetime.now()
+                payload, status_code = {"success": True, "bot": text, "metadata": metadata}, 200
+                if not conversation and response_cache.enabled:
+                    response_cache.set(normalize_query(query), payload)
+            elif text:
+                partial_responses_total.inc()
+                payload, status_code = {
+                    "success": False,
+                    "bot": text,
+                    "warning": "Partial response due to timeout",
+                    "error": final.get("error", "Timeout waiting for response"),
+                    "metadata": metadata
+                }, 206
+            else:
+                timeouts_total.inc()
+                payload, status_code = {"error": final.get("error", "No response received"), "metadata": metadata}, 408
+        except Exception as e:
+            logging.error(f"❌ Background job {job.id} failed", exc_info=True)
+            payload = {"error": "Server error occurred", "details": str(e)}
+        finally:
+            session.record_outcome(ok)
+            pool.checkin(session)
+            job.finish(payload, status_code)
+            logging.info(f"📦 Job {job.id} finished with status {status_code}")
+    
+    threading.Thread(target=finish, name=f"continue-{job.id[:8]}", daemon=True).start()
+    return job
+
+def deadline_payload(job, result, deadline, timer):
+    """(payload, status) for an answer cut short by its deadline: 206 with the
+    text read so far, or 202 when nothing has arrived yet"""
+    deadlines_total.inc()
+    text = result.get("response")
+    payload = {
+        "success": False,
+        "error": "Deadline reached",
+        "job_id": job.id,
+        "warning": f"Deadline of {deadline.budget_ms}ms reached; poll /jobs/{job.id} for the full answer",
+        "metadata": {"deadline_ms": deadline.budget_ms, "phases": timer.to_dict()}
+    }
+    if text and text.strip():
+        partial_responses_total.inc()
+        payload["bot"] = text
+        return payload, 206
+    return payload, 202
+
+def sse_event(event, data):
+    """Format a single Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+pool = SessionPool(POOL_SIZE, POOL_MAX_WAITERS, POOL_CHECKOUT_TIMEOUT)
+jobs = JobQueue(JOB_WORKERS, JOB_QUEUE_MAX, JOB_RETENTION_SECONDS)
+response_cache = ResponseCache(CACHE_ENABLED, CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, CACHE_DB_PATH, CACHE_DB_MAX_ENTRIES)
+inflight = SingleFlight()
+rate_limiter = RateLimiter(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST)
+screenshot_cache = ScreenshotCache(SCREENSHOT_CACHE_TTL)
+conversations = ConversationRegistry(CONVERSATION_TTL_SECONDS)
+browsers = [SharedBrowser(i) for i in range(math.ceil(pool.size / BROWSER_MAX_TABS))] if BROWSER_MAX_TABS > 1 else []
+prober = HealthProber(pool, HEALTH_PROBE_INTERVAL)
+
+metrics = MetricsRegistry()
+phase_duration = metrics.register(Histogram(
+    "ask_phase_duration_seconds", "Duration of each phase of a browser round trip"))
+request_duration = metrics.register(Histogram(
+    "ask_request_duration_seconds", "End-to-end query latency, including cache hits"))
+requests_total = metrics.register(Counter(
+    "ask_requests_total", "Answered queries by HTTP status code"))
+send_retries_total = metrics.register(Counter(
+    "ask_send_retries_total", "Send attempts after the first one"))
+partial_responses_total = metrics.register(Counter(
+    "ask_partial_responses_total", "Queries answered with a 206 partial response"))
+timeouts_total = metrics.register(Counter(
+    "ask_timeouts_total", "Queries that ended in a 408 timeout"))
+deadlines_total = metrics.register(Counter(
+    "ask_deadline_reached_total", "Queries whose deadline_ms ran out before the answer was complete"))
+session_reinits_total = metrics.register(Counter(
+    "session_reinitializations_total", "Browser sessions (re)initialized by setup_chatgpt_session"))
+session_recycles_total = metrics.register(Counter(
+    "session_recycles_total", "Memory reclamation steps by action (new_thread, reload, restart, browser_restart)"))
+rejected_total = metrics.register(Counter(
+    "ask_rejected_total", "Requests refused by admission control, by reason"))
+in_flight_requests = metrics.register(Gauge(
+    "ask_in_flight_requests", "Queries currently being processed"))
+metrics.register(Gauge(
+    "browser_session_age_seconds", "Seconds since each browser session was started",
+    callback=lambda: [
+        ({"session": s.id}, round((datetime.now() - s.created_at).total_seconds(), 1))
+        for s in pool.sessions if s.created_at
+    ]))
+metrics.register(Gauge(
+    "browser_js_heap_used_bytes", "Renderer JS heap at the last idle memory sample",
+    callback=lambda: [
+        ({"session": s.id}, s.memory["heap_used_mb"] * 2**20)
+        for s in pool.sessions if s.memory
+    ]))
+metrics.register(Gauge(
+    "browser_pool_idle_sessions", "Browser sessions not checked out",
+    callback=lambda: pool.stats()["idle"]))
+metrics.register(Gauge(
+    "job_queue_depth", "Jobs waiting for a worker", callback=jobs.depth))
+
+def record_phases(timer):
+    """Feed a finished request's phase timings into the phase histogram"""
+    for name, value in timer.to_dict().items():
+        phase_duration.observe(value / 1000, phase=name[:-len("_ms")])
+
+def client_key():
+    """Rate-limit identity: a configured API key if one is sent, else the client address
+
+    remote_addr only reflects X-Forwarded-For when TRUSTED_PROXY_HOPS
+    enables ProxyFix, so clients cannot pick their own bucket.
+    """
+    api_key = request.headers.get("X-API-Key")
+    if api_key and api_key in RATE_LIMIT_API_KEYS:
+        return "key:" + api_key
+    return "ip:" + (request.remote_addr or "")
+
+def too_many_requests(error, retry_after, reason):
+    """429 with a Retry-After header, rounded up to whole seconds"""
+    rejected_total.inc(reason=reason)
+    retry_after = max(1, math.ceil(retry_after))
+    response = jsonify({"error": error, "retry_after": retry_after})
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+def rate_limit(cost=1):
+    """Charge the caller's token bucket; returns a 429 response or None"""
+    wait = rate_limiter.take(client_key(), cost)
+    if wait:
+        return too_many_requests("Rate limit exceeded", wait, "rate_limit")
+    return None
+
+def pool_busy_payload(e):
+    """(payload, status) for a failed checkout: 429 when overloaded, 503 when shutting down"""
+    logging.warning(f"🚦 Browser pool busy: {e}")
+    if e.retry_after is None:
+        return {"error": "All browser sessions are busy", "details": str(e)}, 503
+    rejected_total.inc(reason="overload")
+    return {
+        "error": "All browser sessions are busy",
+        "details": str(e),
+        "retry_after": max(1, math.ceil(e.retry_after))
+    }, 429
+
+def with_retry_after(payload, status_code):
+    """jsonify a payload, copying its retry_after into a Retry-After header"""
+    response = jsonify(payload)
+    if status_code == 429 and payload.get("retry_after"):
+        response.headers["Retry-After"] = str(payload["retry_after"])
+    return response, status_code
+
+@app.before_request
+def admit_request():
+    """Refuse new work once shutdown has started, and apply rate limits
+
+    Batches are charged per prompt inside ask_batch.
+    """
+    if request.endpoint not in ("ask", "ask_stream", "ask_batch", "submit_job"):
+        return None
+    if pool.draining:
+        return jsonify({"error": "Server is shutting down"}), 503
+    if request.endpoint != "ask_batch":
+        return rate_limit()
+    return None
+
+@app.route('/ask')
+def ask():
+    try:
+        query = request.args.get("q")
+        if not query or not query.strip():
+            return jsonify({"error": "No query provided"}), 400
+
+        query = query.strip()
+        use_cache = request.args.get("cache", "1").lower() not in ("0", "false", "no")
+        conversation_id = parse_conversation_id(request.args.get("conversation_id"))
+        try:
+            deadline = parse_deadline(request.args.get("deadline_ms"))
+        except ValueError:
+            return jsonify({"error": "deadline_ms must be a positive integer"}), 400
+        payload, status_code = execute_query(query, use_cache=use_cache, conversation_id=conversation_id,
+                                             deadline=deadline)
+        response, status_code = with_retry_after(payload, status_code)
+        if payload.get("job_id"):
+            response.headers["Location"] = f"/jobs/{payload['job_id']}"
+        return response, status_code
+    
+    except Exception as e:
+        logging.error("❌ Critical error in /ask endpoint", exc_info=True)
+        return jsonify({
+            "error": "Server error occurred",
+            "details": str(e),
+            "timestamp": datetime.now().isoformat()
+        }), 500
+
+def lookup_cached(query, timer):
+    """Return a cached payload for the query, annotated as a hit, or None"""
+    if not response_cache.enabled:
+        return None
+    
+    cached = response_cache.get(normalize_query(query))
+    if cached is None:
+        return None
+    
+    payload, age = cached
+    logging.info(f"⚡ Cache hit for query: {query[:100]}...")
+    metadata = payload.setdefault("metadata", {})
+    metadata["cache"] = "hit"
+    metadata["cache_age_seconds"] = round(age, 1)
+    metadata["phases"] = timer.to_dict()
+    return payload
+
+def parse_conversation_id(value):
+    """None for no conversation; "new" asks the server to mint an id"""
+    if not value or not str(value).strip():
+        return None
+    value = str(value).strip()
+    return uuid.uuid4().hex if value == "new" else value
+
+def parse_deadline(value):
+    """Deadline from a deadline_ms parameter, None when absent; raises ValueError"""
+    if value is None or not str(value).strip():
+        return None
+    budget_ms = int(value)
+    if budget_ms <= 0:
+        raise ValueError(f"deadline_ms must be positive, got {budget_ms}")
+    return Deadline(budget_ms)
+
+def execute_query(query, timer=None, checkout_timeout=None, use_cache=True, conversation_id=None, deadline=None):
+    """Answer a query from the cache or a browser session
+
+    Returns (payload, status_code). Shared by /ask and the background job
+    workers; never raises. Conversation turns depend on earlier context,
+    so they bypass the cache and coalescing.
+    """
+    timer = timer or PhaseTimer()
+    in_flight_requests.inc()
+    try:
+        if conversation_id:
+            payload, status_code = run_query(query, timer, checkout_timeout, conversation_id, deadline)
+            payload.setdefault("metadata", {})["cache"] = "bypass"
+        else:
+            payload, status_code = answer_query(query, timer, checkout_timeout, use_cache, deadline)
+    finally:
+        in_flight_requests.dec()
     
-    dismiss_script = """
-    let dismissed = false;
-    const popupSelectors = [
-        // Stay logged out popup
-        'a[href*="logout"]',
-        'button:contains("Stay logged out")',
-        'a:contains("Stay logged out")',
-        
-        // Modal close buttons
-        '[data-testid*="close"]',
-        '.modal button[aria-label="Close"]',
-        'button[aria-label="Close"]',
-        
-        // Cookie banners
-        'button:contains("Accept")',
-        'button:contains("OK")',
-        
-        // Other common popups
-        '[role="dialog"] button',
-        '.popup button',
-        '.overlay button'
-    ];
+    record_request(timer, status_code)
+    return payload, status_code
+
+def record_request(timer, status_code):
+    """Count a finished query and its end-to-end latency"""
+    request_duration.observe(time.monotonic() - timer.started)
+    requests_total.inc(code=status_code)
+
+def answer_query(query, timer, checkout_timeout, use_cache, deadline=None):
+    """Cache lookup, then a (possibly coalesced) browser round trip
+
+    Queries with a deadline are not coalesced: a shared round trip would
+    run on the first caller's budget.
+    """
+    if use_cache:
+        cached = lookup_cached(query, timer)
+        if cached is not None:
+            return cached, 200
     
-    // Try text-based selectors
-    const textSelectors = [
-        "Stay logged out",
-        "Accept all",
-        "Continue",
-        "Got it",
-        "OK",
-        "Close"
-    ];
+    key = normalize_query(query)
+    cache_status = "miss" if use_cache and response_cache.enabled else "bypass"
     
-    for (const text of textSelectors) {
-        const elements = Array.from(document.querySelectorAll('button, a, [role="button"]'))
-            .filter(el => el.textContent.trim().toLowerCase().includes(text.toLowerCase()));
-        
-        for (const el of elements) {
-            if (el.offsetParent !== null) { // Check if visible
-                el.click();
-                dismissed = true;
-                break;
-            }
-        }
-        if (dismissed) break;
-    }
+    def drive_browser():
+        payload, status_code = run_query(query, timer, checkout_timeout, deadline=deadline)
+        if status_code == 200 and response_cache.enabled:
+            response_cache.set(key, payload)
+        return json.dumps(payload), status_code
     
-    // Try selector-based dismissal
-    if (!dismissed) {
-        for (const selector of popupSelectors) {
-            try {
-                const element = document.querySelector(selector);
-                if (element && element.offsetParent !== null) {
-                    element.click();
-                    dismissed = true;
-                    break;
-                }
-            } catch (e) { /* ignore */ }
-        }
-    }
+    if COALESCE_ENABLED and deadline is None:
+        (body, status_code), coalesced = inflight.do(key, drive_browser)
+    else:
+        (body, status_code), coalesced = drive_browser(), False
     
-    return dismissed;
+    # Every caller gets its own copy of the shared payload
+    payload = json.loads(body)
+    metadata = payload.setdefault("metadata", {})
+    metadata["cache"] = cache_status
+    metadata["coalesced"] = coalesced
+    if coalesced:
+        logging.info(f"🔗 Coalesced with in-flight query: {query[:100]}...")
+    return payload, status_code
+
+def checkout_for(conversation_id, timeout=None):
+    """Check out the session a conversation is pinned to (or any, for new ones)
+
+    Returns (session, conversation); conversation is None without an id.
     """
+    if not conversation_id:
+        return pool.checkout(timeout), None
+    
+    conversation = conversations.get(conversation_id)
+    session = pool.checkout(timeout, session_id=conversation.session_id if conversation else None)
+    if conversation is None:
+        conversation = conversations.create(conversation_id, session.id)
+    return session, conversation
+
+def run_query(query, timer, checkout_timeout=None, conversation_id=None, deadline=None):
+    """Check out a session, run the query and return (payload, status_code)"""
+    logging.info(f"🔐 Processing query: {query[:100]}...")
     
+    if deadline is not None:
+        checkout_timeout = within_deadline(deadline, POOL_CHECKOUT_TIMEOUT if checkout_timeout is None else checkout_timeout)
     try:
-        for attempt in range(3):
-            dismissed = driver.execute_script(dismiss_script)
-            if dismissed:
-                logging.info(f"✅ Popup dismissed on attempt {attempt + 1}")
-                time.sleep(2)
-                return True
-            time.sleep(2)
-        
-        logging.info("ℹ️ No popups found to dismiss")
-        return False
-        
-    except Exception as e:
-        logging.error("❌ Error while dismissing popups", exc_info=True)
-        return False
+        with timer.phase("checkout"):
+            session, conversation = checkout_for(conversation_id, checkout_timeout)
+    except PoolBusyError as e:
+        return pool_busy_payload(e)
 
-def check_session_health():
-    """Check if the current session is healthy"""
+    continued = False
     try:
-        # Test basic page interaction
-        title = driver.title
-        url = driver.current_url
-        
-        # Check if we're still on ChatGPT
-        if "chatgpt.com" not in url.lower():
-            logging.warning(f"⚠️ Not on ChatGPT page: {url}")
-            return False
-            
-        # Check if page is responsive
-        driver.execute_script("return document.readyState;")
-        
-        # Look for chat interface elements
-        has_input = driver.execute_script("""
-            const selectors = [
-                '[contenteditable="true"]',
-                'textarea',
-                '#prompt-textarea',
-                '[data-testid="textbox"]'
-            ];
-            return selectors.some(sel => document.querySelector(sel) !== null);
-        """)
-        
-        if not has_input:
-            logging.warning("⚠️ No input element found")
-            return False
-            
-        logging.info("✅ Session health check passed")
-        return True
-        
+        try:
+            payload, status_code = handle_query(session, query, timer, conversation, deadline)
+            session.record_outcome(status_code == 200)
+            if status_code == 200:
+                # Ready the input for whoever checks this session out next
+                preposition_input(session)
+        except DeadlineReached as e:
+            job = continue_in_background(session, query, conversation, e.result, timer, e.baseline_count)
+            continued = True
+            payload, status_code = deadline_payload(job, e.result, deadline, timer)
+        if conversation:
+            payload.setdefault("metadata", {}).update({
+                "conversation_id": conversation.id,
+                "conversation_turn": conversation.turns
+            })
+        return payload, status_code
     except Exception as e:
-        logging.error("❌ Session health check failed", exc_info=True)
-        return False
+        logging.error("❌ Critical error while processing query", exc_info=True)
+        session.record_outcome(False)
+        return {
+            "error": "Server error occurred",
+            "details": str(e),
+            "timestamp": datetime.now().isoformat()
+        }, 500
+    finally:
+        if not continued:
+            pool.checkin(session)
+        record_phases(timer)
+
+def prepare_and_send(session, query, timer, conversation=None, deadline=None):
+    """Make sure the session is usable and send the query, with retries
+
+    Returns (sent, baseline_count), the latter being the number of
+    assistant messages before the send.
+    """
+    if not ensure_session_ready(session, timer, conversation, deadline):
+        return False, None
+    baseline_count = count_assistant_messages(session.driver)
+    return send_with_retries(session, query, timer, deadline), baseline_count
+
+def ensure_session_ready(session, timer, conversation=None, deadline=None):
+    """Reinitialize the session if needed, clear popups and pick the thread
+
+    Returns False when ``deadline`` ran out before the session was ready.
+    """
+    # Check session health and reinitialize if needed
+    with timer.phase("health_check"):
+        healthy, sweep_popups = verify_session(session) if session.setup_complete else (False, True)
+    if not healthy:
+        if deadline is not None and deadline.expired:
+            logging.warning(f"⏰ Deadline reached before session {session.id} could be reinitialized")
+            return False
+        logging.info(f"🔄 Reinitializing session {session.id}...")
+        with timer.phase("setup"):
+            try:
+                setup_chatgpt_session(session, deadline)
+            except Exception:
+                if deadline is not None and deadline.expired:
+                    logging.warning(f"⏰ Deadline reached while reinitializing session {session.id}")
+                    return False
+                raise
+    
+    driver = session.driver
+    session.request_count += 1
+    browser = browser_of(session)
+    if browser:
+        browser.count_request()
+    
+    # Dismiss any popups before processing
+    if sweep_popups:
+        with timer.phase("dismiss_popups"):
+            if dismiss_popups(driver, within_deadline(deadline, POPUP_SETTLE_TIMEOUT)):
+                session.last_popup_at = datetime.now()
+    
+    with timer.phase("select_thread"):
+        select_thread(session, conversation, deadline)
+    return True
 
-def setup_chatgpt_session():
-    """Setup ChatGPT session with enhanced error handling"""
-    global setup_complete, last_activity
+def send_with_retries(session, query, timer, deadline=None):
+    """Send the query, dismissing popups between failed attempts
+
+    No further attempt is made once ``deadline`` has run out.
+    """
+    driver = session.driver
     
-    try:
-        if not initialize_driver():
-            raise Exception("Failed to initialize driver")
-            
-        logging.info("🌐 Navigating to ChatGPT...")
-        driver.get("https://chatgpt.com")
+    # Start following the network stream of the message we are about to send
+    if session.stream_watcher:
+        session.stream_watcher.reset()
+    
+    # Attempt to send message with retries
+    send_success = False
+    for attempt in range(MAX_RETRIES):
+        if deadline is not None and deadline.expired:
+            logging.warning("⏰ Deadline reached before the message could be sent")
+            break
+        logging.info(f"📝 Sending message (attempt {attempt + 1}/{MAX_RETRIES})")
+        if attempt:
+            send_retries_total.inc()
         
-        # Wait for initial page load
-        WebDriverWait(driver, 20).until(
-            lambda d: d.execute_script("return document.readyState") == "complete"
-        )
+        with timer.phase("send"):
+            send_result = send_message_to_chatgpt(driver, query, deadline)
+        
+        if send_result.get('success'):
+            send_success = True
+            logging.info("✅ Message sent successfully")
+            break
+        else:
+            logging.warning(f"⚠️ Send attempt {attempt + 1} failed: {send_result.get('error')}")
+            if attempt < MAX_RETRIES - 1:
+                with timer.phase("retry_wait"):
+                    wait_for_chat_input(driver, within_deadline(deadline, SEND_RETRY_READY_TIMEOUT))
+                    dismiss_popups(driver, within_deadline(deadline, POPUP_SETTLE_TIMEOUT))  # Try dismissing popups between attempts
+    
+    return send_success
+
+DEADLINE_BEFORE_SEND = "Deadline reached before the message was sent"
+
+def handle_query(session, query, timer, conversation=None, deadline=None):
+    """Run a single query against a checked-out session
+
+    Raises DeadlineReached when ``deadline`` runs out while the answer is
+    still being generated.
+    """
+    sent, baseline_count = prepare_and_send(session, query, timer, conversation, deadline)
+    if not sent:
+        if deadline is not None and deadline.expired:
+            deadlines_total.inc()
+            return {"error": DEADLINE_BEFORE_SEND,
+                    "metadata": {"deadline_ms": deadline.budget_ms, "phases": timer.to_dict()}}, 408
+        return {"error": "Failed to send message after retries", "metadata": {"phases": timer.to_dict()}}, 500
+    
+    # Wait for response
+    logging.info("⏳ Waiting for ChatGPT response...")
+    wait_timeout = within_deadline(deadline, RESPONSE_TIMEOUT)
+    with timer.phase("wait_response"):
+        response_result = wait_for_session_response(session, wait_timeout, baseline_count)
+    record_turn(session, conversation)
+    if wait_timeout < RESPONSE_TIMEOUT and not response_result.get('success'):
+        raise DeadlineReached(response_result, baseline_count)
+    
+    if response_result.get('success') and response_result.get('response'):
+        response_text = response_result['response']
+        wait_time = response_result.get('waitTime', 0)
         
-        logging.info("⏳ Waiting for page elements to load...")
-        time.sleep(15)
+        logging.info(f"✅ Response received after {wait_time}ms")
+        logging.debug(f"Response length: {len(response_text)} characters")
         
-        # Dismiss any popups
-        dismiss_popups()
+        session.last_activity = datetime.now()
         
-        # Verify we have the chat interface
-        if not check_session_health():
-            raise Exception("Chat interface not available")
-            
-        setup_complete = True
-        last_activity = datetime.now()
-        logging.info("✅ ChatGPT session setup completed")
+        return {
+            "success": True,
+            "bot": response_text,
+            "metadata": {
+                "wait_time_ms": wait_time,
+                "response_length": len(response_text),
+                "completion_detected_by": response_result.get('detectedBy'),
+                "session_id": session.id,
+                "phases": timer.to_dict()
+            }
+        }, 200
+    else:
+        error_msg = response_result.get('error', 'No response received')
+        partial_response = response_result.get('response')
         
-        return True
+        logging.warning(f"⚠️ {error_msg}")
         
-    except Exception as e:
-        logging.error("❌ Failed to setup ChatGPT session", exc_info=True)
-        setup_complete = False
-        raise
+        # Return partial response if available
+        if partial_response and len(partial_response.strip()) > 0:
+            partial_responses_total.inc()
+            return {
+                "success": False,
+                "bot": partial_response,
+                "warning": "Partial response due to timeout",
+                "error": error_msg,
+                "metadata": {"phases": timer.to_dict()}
+            }, 206  # Partial Content
+        else:
+            timeouts_total.inc()
+            return {"error": error_msg, "metadata": {"phases": timer.to_dict()}}, 408  # Request Timeout
 
-def send_message_to_chatgpt(message):
-    """Send message to ChatGPT with enhanced reliability"""
+@app.route('/ask/stream')
+def ask_stream():
+    """Stream the answer as Server-Sent Events while the assistant types"""
+    query = request.args.get("q")
+    if not query or not query.strip():
+        return jsonify({"error": "No query provided"}), 400
+
+    query = query.strip()
+    logging.info(f"🔐 Streaming query: {query[:100]}...")
+    timer = PhaseTimer()
     
-    send_script = """
-    const callback = arguments[arguments.length - 1];
-    const message = arguments[0];
+    conversation_id = parse_conversation_id(request.args.get("conversation_id"))
+    try:
+        deadline = parse_deadline(request.args.get("deadline_ms"))
+    except ValueError:
+        return jsonify({"error": "deadline_ms must be a positive integer"}), 400
+    use_cache = request.args.get("cache", "1").lower() not in ("0", "false", "no") and not conversation_id
+    cached = lookup_cached(query, timer) if use_cache else None
+    if cached is not None:
+        record_request(timer, 200)
+        body = sse_event("delta", {"text": cached.get("bot", "")}) + sse_event("done", cached)
+        return Response(body, mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
     
-    (async () => {
-        try {
-            // Wait for page to be ready
-            if (document.readyState !== 'complete') {
-                await new Promise(resolve => {
-                    const checkReady = () => {
-                        if (document.readyState === 'complete') resolve();
-                        else setTimeout(checkReady, 100);
-                    };
-                    checkReady();
-                });
-            }
-            
-            // Dismiss any popups first
-            await new Promise(resolve => setTimeout(resolve, 1000));
-            
-            // Find input element with multiple strategies
-            const inputSelectors = [
-                '[contenteditable="true"]',
-                '#prompt-textarea', 
-                'textarea[placeholder*="Message"]',
-                '[data-testid="textbox"]',
-                '.ProseMirror[contenteditable="true"]'
-            ];
-            
-            let inputElement = null;
-            for (const selector of inputSelectors) {
-                const elements = document.querySelectorAll(selector);
-                for (const el of elements) {
-                    if (el.offsetParent !== null && !el.disabled && !el.readOnly) {
-                        inputElement = el;
-                        break;
-                    }
-                }
-                if (inputElement) break;
-            }
-            
-            if (!inputElement) {
-                callback({ success: false, error: "No input element found" });
-                return;
-            }
-            
-            // Focus and clear the input
-            inputElement.focus();
-            await new Promise(resolve => setTimeout(resolve, 500));
-            
-            // Clear existing content
-            if (inputElement.tagName.toLowerCase() === 'textarea') {
-                inputElement.value = '';
-            } else {
-                inputElement.innerHTML = '';
-                inputElement.textContent = '';
-            }
-            
-            // Type the message
-            if (inputElement.tagName.toLowerCase() === 'textarea') {
-                inputElement.value = message;
-                inputElement.dispatchEvent(new Event('input', { bubbles: true }));
-                inputElement.dispatchEvent(new Event('change', { bubbles: true }));
-            } else {
-                // For contenteditable elements
-                inputElement.textContent = message;
-                inputElement.dispatchEvent(new Event('input', { bubbles: true }));
-            }
-            
-            // Wait for the text to be set
-            await new Promise(resolve => setTimeout(resolve, 1000));
+    try:
+        with timer.phase("checkout"):
+            session, conversation = checkout_for(conversation_id, within_deadline(deadline, POOL_CHECKOUT_TIMEOUT))
+    except PoolBusyError as e:
+        payload, status_code = pool_busy_payload(e)
+        record_request(timer, status_code)
+        return with_retry_after(payload, status_code)
+
+    released = threading.Event()
+
+    def release():
+        if not released.is_set():
+            released.set()
+            pool.checkin(session)
+
+    def generate():
+        in_flight_requests.inc()
+        answered = False
+        # Counted like /ask; 499 when the client leaves before a result
+        status_code = 499
+        try:
+            yield sse_event("start", {"session_id": session.id})
             
-            // Verify text was set correctly
-            const currentText = inputElement.tagName.toLowerCase() === 'textarea' 
-                ? inputElement.value 
-                : inputElement.textContent || inputElement.innerText;
-                
-            if (!currentText.includes(message.substring(0, 50))) {
-                callback({ success: false, error: "Failed to set message text" });
-                return;
-            }
+            ready = ensure_session_ready(session, timer, conversation, deadline)
+            driver = session.driver
+            baseline_count = read_response_snapshot(driver).get("count", 0) if ready else 0
             
-            // Find and click send button
-            const sendSelectors = [
-                'button[data-testid="send-button"]',
-                'button[aria-label*="Send"]',
-                '[data-testid="fruitjuice-send-button"]',
-                'button svg[data-testid*="send"]',
-                'form button[type="submit"]',
-                'button:has(svg)'
-            ];
+            if not (ready and send_with_retries(session, query, timer, deadline)):
+                if deadline is not None and deadline.expired:
+                    deadlines_total.inc()
+                    status_code = 408
+                    yield sse_event("error", {"error": DEADLINE_BEFORE_SEND, "deadline_ms": deadline.budget_ms})
+                else:
+                    status_code = 500
+                    yield sse_event("error", {"error": "Failed to send message after retries"})
+                return
             
-            let sendButton = null;
-            for (const selector of sendSelectors) {
-                const buttons = document.querySelectorAll(selector);
-                for (const btn of buttons) {
-                    if (btn.offsetParent !== null && !btn.disabled) {
-                        sendButton = btn;
-                        break;
-                    }
-                }
-                if (sendButton) break;
-            }
+            wait_timeout = within_deadline(deadline, RESPONSE_TIMEOUT)
+            if session.cdp and session.cdp.alive:
+                updates = cdp_response_updates(session, wait_timeout)
+            else:
+                updates = poll_response_updates(driver, baseline_count, wait_timeout)
             
-            if (!sendButton) {
-                // Try finding by proximity to input
-                const allButtons = Array.from(document.querySelectorAll('button'));
-                sendButton = allButtons.find(btn => 
-                    btn.offsetParent !== null && 
-                    !btn.disabled &&
-                    btn.getBoundingClientRect().top > inputElement.getBoundingClientRect().top - 100 &&
-                    btn.getBoundingClientRect().top < inputElement.getBoundingClientRect().bottom + 100
-                );
-            }
+            sent_text = ""
+            result = {}
+            for kind, value in updates:
+                if kind == "done":
+                    result = value
+                    break
+                if value.startswith(sent_text):
+                    yield sse_event("delta", {"text": value[len(sent_text):]})
+                else:
+                    # Earlier text was rewritten (e.g. markdown re-render)
+                    yield sse_event("reset", {"text": value})
+                sent_text = value
             
-            if (sendButton && !sendButton.disabled) {
-                sendButton.click();
-                callback({ success: true, message: "Message sent successfully" });
-            } else {
-                callback({ success: false, error: "Send button not found or disabled" });
+            record_turn(session, conversation)
+            wait_time = result.get("waitTime", 0)
+            timer.phases["wait_response"] = wait_time
+            text = result.get("response") or sent_text
+            metadata = {
+                "wait_time_ms": wait_time,
+                "response_length": len(text),
+                "completion_detected_by": result.get("detectedBy"),
+                "session_id": session.id,
+                "phases": timer.to_dict()
             }
+            if conversation:
+                metadata["conversation_id"] = conversation.id
+                metadata["conversation_turn"] = conversation.turns
             
-        } catch (error) {
-            callback({ success: false, error: "JavaScript error: " + error.toString() });
-        }
-    })();
+            if result.get("success"):
+                answered = True
+                session.last_activity = datetime.now()
+                logging.info(f"✅ Streamed response completed after {wait_time}ms")
+                payload = {"success": True, "bot": text, "metadata": metadata}
+                if not conversation and response_cache.enabled:
+                    response_cache.set(normalize_query(query), payload)
+                status_code = 200
+                yield sse_event("done", payload)
+            elif wait_timeout < RESPONSE_TIMEOUT:
+                # The background job now owns the session
+                result["response"] = text
+                job = continue_in_background(session, query, conversation, result, timer, baseline_count)
+                answered = None
+                released.set()
+                payload, status_code = deadline_payload(job, result, deadline, timer)
+                payload["metadata"].update(metadata)
+                yield sse_event("done", payload)
+            else:
+                logging.warning("⚠️ Timeout while streaming response")
+                if text:
+                    partial_responses_total.inc()
+                    status_code = 206
+                else:
+                    timeouts_total.inc()
+                    status_code = 408
+                yield sse_event("done", {
+                    "success": False,
+                    "bot": text or None,
+                    "error": result.get("error", "Timeout waiting for response"),
+                    "metadata": metadata
+                })
+        
+        except Exception as e:
+            logging.error("❌ Critical error in /ask/stream endpoint", exc_info=True)
+            status_code = 500
+            yield sse_event("error", {"error": "Server error occurred", "details": str(e)})
+        finally:
+            # Also covers clients that disconnect mid-answer
+            if answered is not None:
+                session.record_outcome(answered)
+            if answered:
+                preposition_input(session)
+            in_flight_requests.dec()
+            record_request(timer, status_code)
+            record_phases(timer)
+            release()
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    response.call_on_close(release)
+    return response
+
+@app.route('/ask/batch', methods=['POST'])
+def ask_batch():
+    """Answer many prompts in one call, streaming NDJSON in completion order
+
+    Body: {"items": [{"id": ..., "q": ...}, ...], "concurrency": N} or a
+    bare list of such items (or strings). Items are spread over the browser
+    pool with at most min(N, BATCH_MAX_CONCURRENCY, pool size) in flight.
     """
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        items = data.get("items")
+        concurrency = data.get("concurrency") or BATCH_MAX_CONCURRENCY
+    else:
+        items = data
+        concurrency = BATCH_MAX_CONCURRENCY
     
-    driver.set_script_timeout(30)
-    result = driver.execute_async_script(send_script, message)
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "Expected a non-empty JSON array of items"}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"Too many items ({len(items)} > {BATCH_MAX_ITEMS})"}), 413
     
-    return result
-
-def wait_for_response():
-    """Wait for ChatGPT response with improved detection"""
+    try:
+        concurrency = max(1, min(int(concurrency), BATCH_MAX_CONCURRENCY, pool.size))
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency must be an integer"}), 400
     
-    wait_script = """
-    const callback = arguments[arguments.length - 1];
-    const maxWaitTime = 90000; // 90 seconds
-    const checkInterval = 2000; // 2 seconds
-    const startTime = Date.now();
-    let lastResponse = "";
-    let stableChecks = 0;
-    const requiredStableChecks = 3;
+    prompts = []
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {"q": item}
+        item_id = item.get("id", index) if isinstance(item, dict) else index
+        query = item.get("q") if isinstance(item, dict) else None
+        conversation_id = parse_conversation_id(item.get("conversation_id")) if isinstance(item, dict) else None
+        prompts.append((item_id, query.strip() if isinstance(query, str) else None, conversation_id))
     
-    function extractResponse() {
-        // Multiple selector strategies for assistant messages
-        const selectors = [
-            '[data-message-author-role="assistant"]',
-            '[data-testid*="assistant"]',
-            '.group.w-full.text-token-text-primary',
-            '[role="presentation"] > div > div'
-        ];
-        
-        let assistantMessages = [];
-        for (const selector of selectors) {
-            assistantMessages = document.querySelectorAll(selector);
-            if (assistantMessages.length > 0) break;
-        }
-        
-        if (assistantMessages.length === 0) return null;
-        
-        const lastMessage = assistantMessages[assistantMessages.length - 1];
-        
-        // Check for loading indicators
-        const loadingSelectors = [
-            '.result-thinking',
-            '.loading',
-            '.spinner',
-            '[data-testid*="loading"]',
-            '.animate-pulse'
-        ];
-        
-        const isLoading = loadingSelectors.some(sel => lastMessage.querySelector(sel)) ||
-                         lastMessage.textContent.includes('...') ||
-                         lastMessage.textContent.includes('thinking') ||
-                         lastMessage.textContent.includes('typing');
-        
-        if (isLoading) return null;
-        
-        // Extract text content
-        let content = '';
-        const contentElements = lastMessage.querySelectorAll('p, pre, code, li, div, span');
-        
-        if (contentElements.length > 0) {
-            content = Array.from(contentElements)
-                .map(el => el.textContent?.trim())
-                .filter(text => text && text.length > 0)
-                .join('\\n');
-        } else {
-            content = lastMessage.textContent?.trim() || '';
-        }
-        
-        // Filter out navigation and UI elements
-        const filterPatterns = [
-            /^Copy code$/,
-            /^Share$/,
-            /^Regenerate$/,
-            /^Stop generating$/,
-            /^ChatGPT/
-        ];
-        
-        const lines = content.split('\\n').filter(line => {
-            const trimmed = line.trim();
-            return trimmed.length > 0 && !filterPatterns.some(pattern => pattern.test(trimmed));
-        });
-        
-        return lines.join('\\n').trim();
-    }
+    limited = rate_limit(cost=sum(1 for _, query, _ in prompts if query))
+    if limited:
+        return limited
     
-    function checkForResponse() {
-        const currentResponse = extractResponse();
-        
-        if (currentResponse && currentResponse.length > 0) {
-            if (currentResponse === lastResponse) {
-                stableChecks++;
-                if (stableChecks >= requiredStableChecks) {
-                    callback({
-                        success: true,
-                        response: currentResponse,
-                        waitTime: Date.now() - startTime
-                    });
-                    return;
-                }
-            } else {
-                stableChecks = 0;
-                lastResponse = currentResponse;
-            }
-        }
-        
-        const elapsedTime = Date.now() - startTime;
-        if (elapsedTime > maxWaitTime) {
-            callback({
-                success: false,
-                response: lastResponse || null,
-                error: "Timeout waiting for response",
-                waitTime: elapsedTime
-            });
-            return;
-        }
-        
-        setTimeout(checkForResponse, checkInterval);
-    }
+    logging.info(f"📚 Batch of {len(prompts)} prompt(s) with concurrency {concurrency}")
     
-    checkForResponse();
-    """
+    def run_item(item_id, query, conversation_id):
+        payload, status_code = execute_query(query, checkout_timeout=JOB_CHECKOUT_TIMEOUT, conversation_id=conversation_id)
+        return {"id": item_id, "status": status_code, "result": payload}
     
-    driver.set_script_timeout(REQUEST_TIMEOUT)
-    result = driver.execute_async_script(wait_script)
+    def generate():
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+        try:
+            futures = []
+            for item_id, query, conversation_id in prompts:
+                if not query:
+                    yield json.dumps({"id": item_id, "status": 400, "result": {"error": "No query provided"}}) + "\n"
+                    continue
+                futures.append(executor.submit(run_item, item_id, query, conversation_id))
+            
+            for future in as_completed(futures):
+                yield json.dumps(future.result()) + "\n"
+        finally:
+            # Client went away or we are done: drop anything not yet started
+            executor.shutdown(wait=False, cancel_futures=True)
     
-    return result
+    response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
 
-@app.route('/ask')
-def ask():
-    global setup_complete, last_activity
+def job_response(job):
+    """Serialize a job together with its queue position"""
+    body = job.to_dict()
+    body["position"] = jobs.position(job)
+    body["queue_depth"] = jobs.depth()
+    return body
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue a query and return its job id immediately"""
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    elif not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    query = data.get("q") or request.form.get("q") or request.args.get("q")
+    if not query or not str(query).strip():
+        return jsonify({"error": "No query provided"}), 400
     
     try:
-        query = request.args.get("q")
-        if not query or not query.strip():
-            return jsonify({"error": "No query provided"}), 400
+        conversation_id = data.get("conversation_id") or request.args.get("conversation_id")
+        job = jobs.submit(str(query).strip(), parse_conversation_id(conversation_id))
+    except JobQueueFullError as e:
+        logging.warning(f"🚦 Job queue full: {e}")
+        return jsonify({"error": "Job queue is full", "details": str(e)}), 503
+    
+    logging.info(f"📥 Queued job {job.id}")
+    response = jsonify(job_response(job))
+    response.headers["Location"] = f"/jobs/{job.id}"
+    return response, 202
 
-        query = query.strip()
-        logging.info(f"🔐 Processing query: {query[:100]}...")
-        
-        # Check session health and reinitialize if needed
-        if not setup_complete or not check_session_health():
-            logging.info("🔄 Reinitializing session...")
-            setup_chatgpt_session()
-        
-        # Dismiss any popups before processing
-        dismiss_popups()
-        
-        # Attempt to send message with retries
-        send_success = False
-        for attempt in range(MAX_RETRIES):
-            logging.info(f"📝 Sending message (attempt {attempt + 1}/{MAX_RETRIES})")
-            
-            send_result = send_message_to_chatgpt(query)
-            
-            if send_result.get('success'):
-                send_success = True
-                logging.info("✅ Message sent successfully")
-                break
-            else:
-                logging.warning(f"⚠️ Send attempt {attempt + 1} failed: {send_result.get('error')}")
-                if attempt < MAX_RETRIES - 1:
-                    time.sleep(3)
-                    dismiss_popups()  # Try dismissing popups between attempts
-        
-        if not send_success:
-            return jsonify({"error": "Failed to send message after retries"}), 500
-        
-        # Wait for response
-        logging.info("⏳ Waiting for ChatGPT response...")
-        time.sleep(3)  # Brief pause after sending
-        
-        response_result = wait_for_response()
-        
-        if response_result.get('success') and response_result.get('response'):
-            response_text = response_result['response']
-            wait_time = response_result.get('waitTime', 0)
-            
-            logging.info(f"✅ Response received after {wait_time}ms")
-            logging.debug(f"Response length: {len(response_text)} characters")
-            
-            last_activity = datetime.now()
-            
-            return jsonify({
-                "success": True,
-                "bot": response_text,
-                "metadata": {
-                    "wait_time_ms": wait_time,
-                    "response_length": len(response_text)
-                }
-            })
-        else:
-            error_msg = response_result.get('error', 'No response received')
-            partial_response = response_result.get('response')
-            
-            logging.warning(f"⚠️ {error_msg}")
-            
-            # Return partial response if available
-            if partial_response and len(partial_response.strip()) > 0:
-                return jsonify({
-                    "success": False,
-                    "bot": partial_response,
-                    "warning": "Partial response due to timeout",
-                    "error": error_msg
-                }), 206  # Partial Content
-            else:
-                return jsonify({"error": error_msg}), 408  # Request Timeout
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Return a job's state; ``wait`` long-polls for up to JOB_MAX_WAIT seconds"""
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify({"error": "Unknown job id"}), 404
     
-    except Exception as e:
-        logging.error("❌ Critical error in /ask endpoint", exc_info=True)
-        return jsonify({
-            "error": "Server error occurred",
-            "details": str(e),
-            "timestamp": datetime.now().isoformat()
-        }), 500
+    wait = min(max(request.args.get("wait", 0, type=float), 0), JOB_MAX_WAIT)
+    if wait:
+        job.done.wait(wait)
+    
+    return jsonify(job_response(job)), 200 if job.done.is_set() else 202
+
+@app.route('/jobs')
+def job_stats():
+    """Queue depth and worker usage"""
+    return jsonify(jobs.stats())
+
+@app.route('/cache/flush', methods=['GET', 'POST'])
+def flush_cache():
+    code = request.args.get("code")
+    if code != ADMIN_CODE:
+        logging.warning("🚫 Unauthorized cache flush attempt")
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    flushed = response_cache.flush()
+    logging.info(f"🧹 Response cache flushed ({flushed} entries)")
+    return jsonify({
+        "success": True,
+        "flushed_entries": flushed,
+        "timestamp": datetime.now().isoformat()
+    })
 
 @app.route('/restart')
 def restart_browser():
-    global setup_complete, driver, last_activity
-    
     code = request.args.get("code")
     if code != ADMIN_CODE:
         logging.warning("🚫 Unauthorized restart attempt")
         return jsonify({"error": "Unauthorized"}), 401
     
+    # Take every session out of rotation at once so no in-flight /ask is killed
+    logging.info("♻️ Restarting browser sessions...")
     try:
-        logging.info("♻️ Restarting browser session...")
+        checked_out = pool.checkout_group([s.id for s in pool.sessions], REQUEST_TIMEOUT)
+    except PoolBusyError as e:
+        return with_retry_after(*pool_busy_payload(e))
+    try:
+        for browser in browsers:
+            browser.quit()
         
-        if driver:
+        failed = []
+        for session in checked_out:
             try:
-                driver.quit()
-            except:
-                pass
+                setup_chatgpt_session(session)
+            except Exception:
+                failed.append(session.id)
         
-        setup_complete = False
-        setup_chatgpt_session()
-        last_activity = datetime.now()
+        if failed:
+            return jsonify({"error": f"Restart failed for session(s) {failed}"}), 500
         
-        logging.info("✅ Browser session restarted successfully")
+        logging.info("✅ Browser sessions restarted successfully")
         return jsonify({
             "success": True,
-            "message": "Browser session restarted",
+            "message": f"{len(checked_out)} browser session(s) restarted",
             "timestamp": datetime.now().isoformat()
         })
         
     except Exception as e:
         logging.error("❌ Failed to restart browser", exc_info=True)
         return jsonify({"error": f"Restart failed: {str(e)}"}), 500
+    finally:
+        for session in checked_out:
+            pool.checkin(session)
 
 @app.route("/api/screenshot")
 def serve_screenshot():
+    """Screenshot of a session's page
+
+    Query parameters: format (png/jpeg/webp), quality, scale, max_width,
+    clip (full, viewport or x,y,width,height), tiled (auto/1/0), session.
+    """
     try:
-        if not driver or not setup_complete:
-            return jsonify({"error": "Browser not initialized"}), 503
+        try:
+            options = parse_screenshot_options(request.args)
+            session_id = int(request.args["session"]) if request.args.get("session") else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if session_id is not None and not any(s.id == session_id for s in pool.sessions):
+            return jsonify({"error": f"Unknown session {session_id}"}), 404
+        
+        cache_key = (session_id, tuple(sorted(options.items())))
+        data = screenshot_cache.get(cache_key)
+        if data is None:
+            try:
+                session = pool.checkout(session_id=session_id)
+            except PoolBusyError as e:
+                return with_retry_after(*pool_busy_payload(e))
+            
+            try:
+                if not session.driver or not session.setup_complete:
+                    return jsonify({"error": "Browser not initialized"}), 503
+                    
+                captured = take_screenshot_in_memory(session.driver, options)
+            finally:
+                pool.checkin(session)
             
-        screenshot_png = take_screenshot_in_memory(driver)
+            # Stitching and encoding happen after the session is back in the pool
+            if isinstance(captured, tuple):
+                data = stitch_screenshot_tiles(*captured, options)
+            else:
+                data = captured
+            screenshot_cache.set(cache_key, data)
         
+        extension = "jpg" if options["format"] == "jpeg" else options["format"]
         return send_file(
-            BytesIO(screenshot_png),
-            mimetype="image/png",
+            BytesIO(data),
+            mimetype=SCREENSHOT_FORMATS[options["format"]],
             as_attachment=False,
-            download_name=f"screenshot_{int(time.time())}.png"
+            download_name=f"screenshot_{int(time.time())}.{extension}"
         )
         
     except Exception as e:
@@ -708,20 +4154,33 @@ def serve_screenshot():
 
 @app.route("/status")
 def status():
-    """Health check endpoint"""
-    global last_activity
-    
+    """Health check endpoint, served from the background prober's snapshot"""
     try:
-        session_healthy = setup_complete and check_session_health()
+        snapshot, age = prober.snapshot()
+        last_activity = snapshot["last_activity"]
+        versions = get_binary_versions()
         
         return jsonify({
-            "status": "healthy" if session_healthy else "unhealthy",
-            "setup_complete": setup_complete,
-            "session_healthy": session_healthy,
+            "status": snapshot["status"],
+            "setup_complete": snapshot["setup_complete"],
+            "session_healthy": snapshot["session_healthy"],
+            "healthy_sessions": snapshot["healthy_sessions"],
+            "snapshot_age_seconds": round(age, 1),
             "last_activity": last_activity.isoformat() if last_activity else None,
             "uptime_seconds": time.time() - (last_activity.timestamp() if last_activity else time.time()),
-            "chrome_version": get_binary_version(chrome_bin),
-            "driver_version": get_binary_version(chromedriver_bin)
+            "chrome_version": versions["chrome"],
+            "driver_version": versions["driver"],
+            "pool": pool.stats(),
+            "jobs": jobs.stats(),
+            "cache": response_cache.stats(),
+            "coalescing": inflight.stats(),
+            "admission": {
+                "typical_hold_seconds": round(pool.typical_hold_time(), 1),
+                "rate_limit_per_minute": RATE_LIMIT_PER_MINUTE,
+                "rate_limit_burst": RATE_LIMIT_BURST
+            },
+            "conversations": conversations.stats(),
+            "browsers": [b.to_dict() for b in browsers]
         })
         
     except Exception as e:
@@ -730,35 +4189,173 @@ def status():
             "error": str(e)
         }), 500
 
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus text exposition format"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/status/live")
+def liveness():
+    """Liveness: the process is up and serving requests"""
+    return jsonify({"status": "alive"})
+
+@app.route("/status/ready")
+def readiness():
+    """Readiness: at least one browser session passed its last health check"""
+    snapshot, age = prober.snapshot()
+    ready = snapshot["session_healthy"] and not pool.draining
+    return jsonify({
+        "status": "ready" if ready else ("draining" if pool.draining else "not_ready"),
+        "healthy_sessions": snapshot["healthy_sessions"],
+        "snapshot_age_seconds": round(age, 1)
+    }), 200 if ready else 503
+
 @app.route("/")
 def index():
     """Main page"""
     RENDER_URL = os.getenv("RENDER_EXTERNAL_URL", "http://localhost:10000")
     return render_template("index.html", render_url=RENDER_URL)
 
-if __name__ == '__main__':
+browser_lock = None
+services_lock = threading.Lock()
+services_started = False
+
+def acquire_browser_lock():
+    """Make this process the only owner of the browser pool on this host
+
+    A second worker process (e.g. gunicorn --workers 2) fails here instead
+    of launching its own Chrome instances.
+    """
+    global browser_lock
+    if fcntl is None or not BROWSER_LOCK_PATH:
+        return
+    lock = open(BROWSER_LOCK_PATH, "a+")
     try:
-        # Log system information
-        chrome_version = get_binary_version(chrome_bin)
-        chromedriver_version = get_binary_version(chromedriver_bin)
-        logging.info(f"🧪 Chrome version: {chrome_version}")
-        logging.info(f"🧪 ChromeDriver version: {chromedriver_version}")
-        
-        # Initialize ChatGPT session
-        logging.info("🚀 Initializing ChatGPT session...")
-        setup_chatgpt_session()
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.seek(0)
+        owner = lock.read().strip() or "another process"
+        lock.close()
+        raise RuntimeError(f"Browser pool is already owned by pid {owner} ({BROWSER_LOCK_PATH})")
+    lock.seek(0)
+    lock.truncate()
+    lock.write(str(os.getpid()))
+    lock.flush()
+    browser_lock = lock
+
+def start_services():
+    """Launch the browser pool and background workers once per process"""
+    global services_started
+    with services_lock:
+        if services_started:
+            return
+        acquire_browser_lock()
         
-        # Start Flask app
-        logging.info("🚀 Starting Flask app on port 10000")
-        app.run(host='0.0.0.0', port=10000, debug=False)
+        # Log system information
+        versions = get_binary_versions()
+        logging.info(f"🧪 Chrome version: {versions['chrome']}")
+        logging.info(f"🧪 ChromeDriver version: {versions['driver']}")
         
+        # Initialize ChatGPT sessions
+        logging.info("🚀 Initializing ChatGPT session pool...")
+        if not pool.warm():
+            raise Exception("No browser session could be started")
+        jobs.start()
+        prober.start()
+        services_started = True
+
+def stop_services(timeout=SHUTDOWN_DRAIN_SECONDS):
+    """Drain in-flight requests, then close every browser session"""
+    logging.info(f"🛑 Draining for up to {timeout}s before shutdown...")
+    queued = jobs.pause()
+    busy = pool.drain(timeout)
+    if busy:
+        logging.warning(f"⚠️ {busy} session(s) still busy after {timeout}s; closing anyway")
+    if queued:
+        logging.warning(f"⚠️ Dropping {queued} queued job(s)")
+    prober.stop()
+    pool.close()
+    logging.info("🧹 Driver sessions closed")
+
+def serve():
+    """Production entry point: waitress with HTTP_THREADS threads
+
+    SIGTERM/SIGINT start a drain in the background; the server keeps
+    delivering in-flight responses and exits once the pool is idle.
+    """
+    start_services()
+    draining = threading.Event()
+    drained = threading.Event()
+    
+    def shutdown(signum, frame):
+        # On Python 3.10+ interrupt_main() runs this handler instead of
+        # raising KeyboardInterrupt itself, so the drain thread lands here
+        if drained.is_set():
+            raise KeyboardInterrupt
+        if draining.is_set():
+            logging.info(f"🛑 Received signal {signum}; already draining")
+            return
+        draining.set()
+        logging.info(f"🛑 Received signal {signum}")
+        def drain_and_exit():
+            try:
+                stop_services()
+            finally:
+                drained.set()
+                _thread.interrupt_main()
+        threading.Thread(target=drain_and_exit, name="shutdown", daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    
+    if waitress is None:
+        logging.warning("⚠️ waitress is not installed; falling back to the Flask development server")
+        logging.info(f"🚀 Starting Flask app on port {HTTP_PORT}")
+        app.run(host=HTTP_HOST, port=HTTP_PORT, debug=False, threaded=True)
+        return
+    
+    logging.info(f"🚀 Serving on {HTTP_HOST}:{HTTP_PORT} with waitress ({HTTP_THREADS} threads)")
+    server = waitress.create_server(
+        app, host=HTTP_HOST, port=HTTP_PORT, threads=HTTP_THREADS,
+        channel_timeout=REQUEST_TIMEOUT + 30
+    )
+    server.run()
+
+wsgi_to_asgi = WsgiToAsgi(app) if WsgiToAsgi else None
+
+async def asgi_app(scope, receive, send):
+    """ASGI entry point (``uvicorn app:asgi_app --workers 1``), needs asgiref
+
+    Lifespan events start and drain the browser pool; requests run through
+    the WSGI app on asgiref's thread pool.
+    """
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await asyncio.to_thread(start_services)
+                except Exception as e:
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await asyncio.to_thread(stop_services)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    
+    if wsgi_to_asgi is None:
+        raise RuntimeError("asgiref is required for ASGI serving")
+    await wsgi_to_asgi(scope, receive, send)
+
+if __name__ == '__main__':
+    try:
+        serve()
+    except KeyboardInterrupt:
+        pass
     except Exception as e:
         logging.error("❌ Failed to start application", exc_info=True)
         raise
     finally:
-        if driver:
-            try:
-                driver.quit()
-                logging.info("🧹 Driver session closed")
-            except:
-                pass
+        if not pool.draining:
+            stop_services(timeout=0)
@@ -0,0 +1,207 @@
+"""Offline latency/throughput benchmark for /ask and /ask/stream.
+
+Starts the mock chat page (bench/mock_chat.py), launches app.py pointed at
+it through CHAT_URL, and drives queries at each concurrency level. Reports
+p50/p95/p99 latency, time to first token and requests/sec. No network
+access needed beyond localhost; Chrome and chromedriver must be installed.
+
+    python bench/benchmark.py --concurrency 1,2,4 --requests 20
+    python bench/benchmark.py --json bench_output.json --max-p95-ms 5000
+"""
+import argparse
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from mock_chat import start_mock_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return round(ordered[index], 1)
+
+
+def start_app(chat_url, port, pool_size, workdir):
+    """Start app.py with its own browser lock and profiles; output goes to workdir/app.out"""
+    env = dict(os.environ, CHAT_URL=chat_url, PORT=str(port), POOL_SIZE=str(pool_size),
+               CACHE_ENABLED="0", COALESCE_ENABLED="0",
+               BROWSER_LOCK_PATH=os.path.join(workdir, "browsers.lock"),
+               CHROME_PROFILE_ROOT=os.path.join(workdir, "profiles"),
+               LOG_FILE=os.path.join(workdir, "app.log"))
+    with open(os.path.join(workdir, "app.out"), "wb") as output:
+        return subprocess.Popen([sys.executable, "app.py"], cwd=ROOT, env=env,
+                                stdout=output, stderr=subprocess.STDOUT)
+
+
+def output_tail(path, lines=20):
+    """Last lines of the app's output, for error messages"""
+    try:
+        with open(path, errors="replace") as f:
+            return "".join(f.readlines()[-lines:])
+    except OSError:
+        return ""
+
+
+def wait_ready(app_url, timeout, process=None, output_path=None):
+    """Poll /status/ready; fail early (with the app's output) if the app exits"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process and process.poll() is not None:
+            raise RuntimeError(f"app.py exited with code {process.returncode}:\n{output_tail(output_path)}")
+        try:
+            with urllib.request.urlopen(f"{app_url}/status/ready", timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(1)
+    message = f"{app_url} not ready after {timeout}s"
+    if output_path:
+        message += f"; last app output:\n{output_tail(output_path)}"
+    raise RuntimeError(message)
+
+
+def ask(app_url, query, timeout):
+    """One /ask round trip; time to first token equals total latency"""
+    start = time.monotonic()
+    url = f"{app_url}/ask?" + urllib.parse.urlencode({"q": query, "cache": "0"})
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except urllib.error.HTTPError:
+        ok = False
+    elapsed = (time.monotonic() - start) * 1000
+    return {"ok": ok, "latency_ms": elapsed, "ttft_ms": elapsed}
+
+
+def ask_stream(app_url, query, timeout):
+    """One /ask/stream round trip, noting when the first delta arrives"""
+    start = time.monotonic()
+    url = f"{app_url}/ask/stream?" + urllib.parse.urlencode({"q": query, "cache": "0"})
+    ttft = None
+    ok = False
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            event = None
+            for raw in response:
+                line = raw.decode().rstrip("\n")
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    if event in ("delta", "reset") and ttft is None:
+                        ttft = (time.monotonic() - start) * 1000
+                    elif event == "done":
+                        ok = json.loads(line[len("data: "):]).get("success", False)
+                    elif event == "error":
+                        break
+    except urllib.error.HTTPError:
+        pass
+    return {"ok": ok, "latency_ms": (time.monotonic() - start) * 1000, "ttft_ms": ttft}
+
+
+def run_level(app_url, endpoint, concurrency, requests, timeout):
+    call = ask_stream if endpoint == "stream" else ask
+    queries = [f"benchmark c{concurrency} #{i}" for i in range(requests)]
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda q: call(app_url, q, timeout), queries))
+    wall = time.monotonic() - start
+
+    ok = [r for r in results if r["ok"]]
+    latencies = [r["latency_ms"] for r in ok]
+    ttfts = [r["ttft_ms"] for r in ok if r["ttft_ms"] is not None]
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": requests - len(ok),
+        "requests_per_sec": round(len(ok) / wall, 2) if wall else None,
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p95_ms": percentile(latencies, 95),
+        "latency_p99_ms": percentile(latencies, 99),
+        "ttft_p50_ms": percentile(ttfts, 50),
+        "ttft_p95_ms": percentile(ttfts, 95),
+        "ttft_p99_ms": percentile(ttfts, 99),
+    }
+
+
+def print_table(rows):
+    columns = ["concurrency", "requests", "errors", "requests_per_sec",
+               "latency_p50_ms", "latency_p95_ms", "latency_p99_ms",
+               "ttft_p50_ms", "ttft_p95_ms", "ttft_p99_ms"]
+    print("  ".join(f"{c:>16}" for c in columns))
+    for row in rows:
+        print("  ".join(f"{str(row[c]):>16}" for c in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", default="1,2,4", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=20, help="requests per concurrency level")
+    parser.add_argument("--endpoint", choices=["stream", "ask"], default="stream")
+    parser.add_argument("--app-url", help="benchmark an already running app instead of starting one")
+    parser.add_argument("--app-port", type=int, default=10100)
+    parser.add_argument("--mock-port", type=int, default=0)
+    parser.add_argument("--first-token-ms", type=int, default=200)
+    parser.add_argument("--token-delay-ms", type=int, default=20)
+    parser.add_argument("--tokens", type=int, default=60)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--max-p95-ms", type=float, help="exit non-zero if any level's p95 latency exceeds this")
+    args = parser.parse_args()
+
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    mock = start_mock_server(args.mock_port, args.first_token_ms, args.token_delay_ms, args.tokens)
+    chat_url = f"http://127.0.0.1:{mock.server_address[1]}"
+
+    app_process = None
+    output_path = None
+    workdir = None
+    app_url = args.app_url
+    if not app_url:
+        app_url = f"http://127.0.0.1:{args.app_port}"
+        workdir = tempfile.mkdtemp(prefix="bench-")
+        app_process = start_app(chat_url, args.app_port, max(levels), workdir)
+        output_path = os.path.join(workdir, "app.out")
+    try:
+        wait_ready(app_url, args.startup_timeout, app_process, output_path)
+        # One untimed request so first-navigation costs do not skew level 1
+        ask_stream(app_url, "warm-up", args.timeout)
+        rows = [run_level(app_url, args.endpoint, c, args.requests, args.timeout) for c in levels]
+    finally:
+        if app_process:
+            app_process.terminate()
+            app_process.wait(timeout=30)
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+        mock.shutdown()
+
+    print_table(rows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"endpoint": args.endpoint, "chat_url": chat_url, "levels": rows}, f, indent=2)
+
+    if args.max_p95_ms is not None:
+        slow = [r for r in rows if r["latency_p95_ms"] is None or r["latency_p95_ms"] > args.max_p95_ms]
+        if slow:
+            print(f"p95 latency above {args.max_p95_ms}ms at concurrency {[r['concurrency'] for r in slow]}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Local stand-in for the chat site, used by the offline benchmark.
+
+Serves bench/mock_chat.html at / and /c/<id>, and streams a scripted reply
+from POST /backend-api/conversation as SSE frames at a configurable speed.
+
+    python bench/mock_chat.py --port 8765 --tokens 60 --token-delay-ms 20
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_chat.html")
+
+FILLER = ("The quick brown fox jumps over the lazy dog while the benchmark "
+          "measures how fast every token reaches the client").split()
+
+
+def scripted_reply(prompt, tokens):
+    """Deterministic reply: echo the prompt, then pad with filler words"""
+    words = f"You said: {prompt}.".split()
+    while len(words) < tokens:
+        words.append(FILLER[len(words) % len(FILLER)])
+    return [word + " " for word in words[:max(tokens, 1)]]
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    first_token_ms = 200
+    token_delay_ms = 20
+    tokens = 60
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path != "/" and not path.startswith("/c/"):
+            self.send_error(404)
+            return
+        with open(PAGE_PATH, "rb") as f:
+            body = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path.split("?")[0] != "/backend-api/conversation":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        prompt = json.loads(self.rfile.read(length) or b"{}").get("prompt", "")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        time.sleep(self.first_token_ms / 1000)
+        try:
+            for token in scripted_reply(prompt, self.tokens):
+                self.wfile.write(f"data: {json.dumps({'v': token})}\n\n".encode())
+                self.wfile.flush()
+                time.sleep(self.token_delay_ms / 1000)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+
+def start_mock_server(port=0, first_token_ms=200, token_delay_ms=20, tokens=60):
+    """Serve the mock chat in a background thread; returns the server"""
+    handler = type("ConfiguredMockChatHandler", (MockChatHandler,), {
+        "first_token_ms": first_token_ms,
+        "token_delay_ms": token_delay_ms,
+        "tokens": tokens,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-chat", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the mock chat page")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--first-token-ms", type=int, default=200)
+    parser.add_argument("--token-delay-ms", type=int, default=20)
+    parser.add_argument("--tokens", type=int, default=60)
+    args = parser.parse_args()
+
+    server = start_mock_server(args.port, args.first_token_ms, args.token_delay_ms, args.tokens)
+    print(f"Mock chat on http://127.0.0.1:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
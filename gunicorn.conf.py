@@ -0,0 +1,23 @@
+# gunicorn -c gunicorn.conf.py app:app
+#
+# The browser pool lives in-process, so there is exactly one worker; HTTP
+# concurrency comes from threads. A second worker would fail to take the
+# browser lock (see acquire_browser_lock in app.py).
+import os
+
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '10000')}"
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("HTTP_THREADS", str(max(8, int(os.environ.get("POOL_SIZE", "1")) * 4))))
+timeout = 150
+graceful_timeout = float(os.environ.get("SHUTDOWN_DRAIN_SECONDS", "60"))
+
+
+def post_worker_init(worker):
+    from app import start_services
+    start_services()
+
+
+def worker_exit(server, worker):
+    from app import stop_services
+    stop_services()